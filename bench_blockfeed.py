@@ -0,0 +1,130 @@
+#! /usr/bin/env python3
+"""
+blockfeed benchmark: runs the counterwalletd blockfeed against a mock counterpartyd, serving either a recording of
+a real counterpartyd's responses (made with counterwalletd --record-rpc), or a synthetic chain, and reports how fast
+it gets through it. A scratch mongo database is used, which is dropped afterwards.
+"""
+
+#import before importing other modules
+import gevent
+from gevent import monkey; monkey.patch_all()
+
+import sys
+import argparse
+import logging
+import tempfile
+import shutil
+import time
+
+import pymongo
+import zmq.green as zmq
+
+from lib import (config, blockfeed, database, mockcpd)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='bench_blockfeed', description='Benchmarks the counterwalletd blockfeed against a mock counterpartyd')
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true', help='sets log level to DEBUG instead of INFO')
+    parser.add_argument('--recording', help='replay the counterpartyd responses from this recording (made with counterwalletd --record-rpc)')
+    parser.add_argument('--synthetic-blocks', type=int, default=10000, help='number of blocks in the synthetic chain (if not replaying a recording)')
+    parser.add_argument('--synthetic-credits', type=int, default=1000000, help='number of credits in the synthetic chain')
+    parser.add_argument('--synthetic-addresses', type=int, default=100000, help='number of addresses the synthetic credits are spread over')
+    parser.add_argument('--synthetic-assets', type=int, default=100, help='number of assets issued in the synthetic chain')
+    parser.add_argument('--synthetic-trades', type=int, default=10000, help='number of trades in the synthetic chain')
+    parser.add_argument('--synthetic-seed', type=int, default=0, help='seed for generating the synthetic chain')
+    parser.add_argument('--tip-blocks', type=int, default=0, help='hold back this many blocks at the end of the chain, and release them one at a time once caught up, to measure new block latency')
+    parser.add_argument('--tip-interval', type=float, default=1.0, help='seconds between releasing each held back block')
+    parser.add_argument('--mock-port', type=int, default=14100, help='port for the mock counterpartyd to listen on (on localhost)')
+    parser.add_argument('--no-notify', action='store_true', default=False, help='don\'t publish new block notifications (i.e. have the blockfeed poll)')
+    parser.add_argument('--mongodb-connect', default='localhost', help='the hostname of the mongodb server to connect to')
+    parser.add_argument('--mongodb-port', type=int, default=27017, help='the port used to communicate with mongodb')
+    parser.add_argument('--mongodb-database', default='counterwalletd_bench', help='the scratch mongodb database to use (dropped before and after the run)')
+    parser.add_argument('--keep-db', action='store_true', default=False, help='don\'t drop the scratch database after the run')
+    parser.add_argument('--fast-rebuild', action='store_true', default=False, help='defer building secondary indexes until caught up')
+    parser.add_argument('--blockfeed-prefetch-window', type=int, default=10)
+    parser.add_argument('--blockfeed-range-fetch-size', type=int, default=250)
+    parser.add_argument('--blockfeed-range-fetch-min-behind', type=int, default=500)
+    parser.add_argument('--blockfeed-bulk-flush-blocks', type=int, default=50)
+    parser.add_argument('--blockfeed-undo-depth', type=int, default=100)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+        format='%(asctime)s :: %(levelname)s :: %(message)s')
+    logging.getLogger("requests").setLevel(logging.WARNING)
+
+    if args.recording:
+        chain = mockcpd.RecordedChain(args.recording)
+    else:
+        chain = mockcpd.SyntheticChain(num_blocks=args.synthetic_blocks, num_credits=args.synthetic_credits,
+            num_addresses=args.synthetic_addresses, num_assets=args.synthetic_assets, num_trades=args.synthetic_trades,
+            seed=args.synthetic_seed)
+    if args.tip_blocks >= chain.last_block_index - chain.first_block_index:
+        raise Exception("--tip-blocks must be less than the number of blocks in the chain")
+
+    #set up the config the blockfeed runs off of
+    config.data_dir = tempfile.mkdtemp(prefix='counterwalletd_bench')
+    config.TESTNET = chain.running_info['running_testnet']
+    config.BLOCK_FIRST = chain.first_block_index - 1 #the blockfeed starts at the block after this
+    config.REPARSE_FORCED = True
+    config.FAST_REBUILD = args.fast_rebuild
+    config.COUNTERPARTYD_RPC = 'http://127.0.0.1:%i/api/' % args.mock_port
+    config.COUNTERPARTYD_AUTH = None
+    config.INSIGHT = 'http://127.0.0.1:%i' % args.mock_port
+    config.COUNTERPARTYD_ZMQ_CONNECT = None if args.no_notify else 'inproc://mockcpd_notify'
+    config.BLOCKFEED_PREFETCH_WINDOW = args.blockfeed_prefetch_window
+    config.BLOCKFEED_RANGE_FETCH_SIZE = args.blockfeed_range_fetch_size
+    config.BLOCKFEED_RANGE_FETCH_MIN_BEHIND = args.blockfeed_range_fetch_min_behind
+    config.BLOCKFEED_BULK_FLUSH_BLOCKS = args.blockfeed_bulk_flush_blocks
+    config.BLOCKFEED_UNDO_DEPTH = args.blockfeed_undo_depth
+    config.MESSAGEFEED_BUFFER_SIZE = 10000
+    config.EVENT_LOG_BLOCKS = 2000
+    config.EVENTFEED_ENDPOINT = 'inproc://queue_eventfeed'
+
+    mongo_client = pymongo.MongoClient(args.mongodb_connect, args.mongodb_port)
+    mongo_client.drop_database(args.mongodb_database)
+    mongo_db = mongo_client[args.mongodb_database]
+    database.init_base_indexes(mongo_db)
+
+    zmq_context = zmq.Context()
+    zmq_publisher_eventfeed = zmq_context.socket(zmq.PUB)
+    zmq_publisher_eventfeed.bind(config.EVENTFEED_ENDPOINT)
+    mock_server = mockcpd.MockCounterpartyServer(chain, '127.0.0.1', args.mock_port, zmq_context=zmq_context,
+        zmq_notify_bind=config.COUNTERPARTYD_ZMQ_CONNECT, released_block_index=chain.last_block_index - args.tip_blocks)
+    mock_server.start()
+
+    def wait_for_block(block_index):
+        while config.CURRENT_BLOCK_INDEX < block_index:
+            if feed.dead:
+                raise Exception("Blockfeed died: %s" % feed.exception)
+            gevent.sleep(0.01)
+
+    try:
+        #catch up to the released part of the chain
+        start_time = time.time()
+        feed = gevent.spawn(blockfeed.process_cpd_blockfeed, mongo_db, zmq_context, zmq_publisher_eventfeed)
+        wait_for_block(mock_server.released_block_index)
+        elapsed = time.time() - start_time
+        summary = blockfeed.stats.get_summary()
+        num_blocks = mock_server.released_block_index - chain.first_block_index + 1
+        print "Caught up on %i blocks (%i messages) in %.1f seconds: %.2f blocks/sec, %.1f msgs/sec" % (
+            num_blocks, summary['total_messages'], elapsed, num_blocks / elapsed, summary['total_messages'] / elapsed)
+        print "Average ms/block over the last %i blocks: %s" % (summary['window_blocks'],
+            ', '.join(["%s=%.1f" % (c, summary['avg_block_timings_ms'][c]) for c in blockfeed.stats.CATEGORIES]))
+
+        #then release the held back blocks one at a time, timing how long until each is processed
+        latencies = []
+        for i in xrange(args.tip_blocks):
+            gevent.sleep(args.tip_interval)
+            release_time = time.time()
+            mock_server.release_block()
+            wait_for_block(mock_server.released_block_index)
+            latencies.append(time.time() - release_time)
+        if latencies:
+            print "New block latency over %i blocks: avg %.3f sec, max %.3f sec" % (
+                len(latencies), sum(latencies) / len(latencies), max(latencies))
+    finally:
+        mock_server.stop()
+        shutil.rmtree(config.data_dir, ignore_errors=True)
+        if not args.keep_db:
+            mongo_client.drop_database(args.mongodb_database)
+    sys.exit(0)
@@ -8,6 +8,7 @@ import gevent
 from gevent import monkey; monkey.patch_all()
 
 import os
+import sys
 import argparse
 import json
 import logging
@@ -25,7 +26,7 @@ redis.connection.socket = gevent.socket #make redis play well with gevent
 from socketio import server as socketio_server
 from requests.auth import HTTPBasicAuth
 
-from lib import (config, api, events, blockfeed, siofeeds, util)
+from lib import (config, api, events, blockfeed, siofeeds, util, database, snapshot, mockcpd, presence)
 
 
 if __name__ == '__main__':
@@ -35,6 +36,12 @@ if __name__ == '__main__':
     parser.add_argument('-v', '--verbose', dest='verbose', action='store_true', help='sets log level to DEBUG instead of WARNING')
 
     parser.add_argument('--reparse', action='store_true', default=False, help='force full re-initialization of the counterwalletd database')
+    parser.add_argument('--fast-rebuild', action='store_true', default=False, help='when rebuilding the counterwalletd database, defer building secondary indexes until caught up')
+    parser.add_argument('--export-snapshot', metavar='PATH', help='export the counterwalletd database state to a snapshot file at PATH, then exit')
+    parser.add_argument('--import-snapshot', metavar='PATH', help='replace the counterwalletd database state with the snapshot file at PATH, then exit')
+    parser.add_argument('--role', help='comma separated list of the parts of counterwalletd to run in this process: feed (the blockfeed, which is the only writer, and should run in exactly one process), api, sio (socket.io message feed) and/or chat (socket.io chat). Defaults to all of them')
+    parser.add_argument('--socketio-feed-only', action='store_true', default=False, help='same as --role sio')
+    parser.add_argument('--record-rpc', metavar='PATH', help='record the responses to the blockfeed\'s counterpartyd API calls to PATH (for replaying with bench_blockfeed.py)')
     parser.add_argument('--testnet', action='store_true', default=False, help='use Bitcoin testnet addresses and block numbers')
     parser.add_argument('--data-dir', help='specify to explicitly override the directory in which to keep the config file and log file')
     parser.add_argument('--config-file', help='the location of the configuration file')
@@ -46,6 +53,7 @@ if __name__ == '__main__':
     parser.add_argument('--counterpartyd-rpc-port', type=int, help='the port used to communicate with counterpartyd over JSON-RPC')
     parser.add_argument('--counterpartyd-rpc-user', help='the username used to communicate with counterpartyd over JSON-RPC')
     parser.add_argument('--counterpartyd-rpc-password', help='the password used to communicate with counterpartyd over JSON-RPC')
+    parser.add_argument('--counterpartyd-zmq-connect', help='the ZeroMQ endpoint (e.g. tcp://localhost:4010) that counterpartyd (or a stand-in) publishes a notification to on each new block, to check for new blocks as soon as they are processed instead of polling')
 
     parser.add_argument('--insight-connect', help='the insight server hostname or IP to connect to')
     parser.add_argument('--insight-port', type=int, help='the insight server port to connect to')
@@ -57,6 +65,7 @@ if __name__ == '__main__':
     parser.add_argument('--mongodb-password', help='the optional password used to communicate with mongodb')
 
     parser.add_argument('--redis-enable-apicache', action='store_true', default=False, help='set to true to enable caching of API requests')
+    parser.add_argument('--redis-enable-presence', action='store_true', default=False, help='set to true to share chat online status (presence) between counterwalletd processes through redis')
     parser.add_argument('--redis-connect', help='the hostname of the redis server to use for caching (if enabled')
     parser.add_argument('--redis-port', type=int, help='the port used to connect to the redis server for caching (if enabled)')
     parser.add_argument('--redis-database', type=int, help='the redis database ID (int) used to connect to the redis server for caching (if enabled)')
@@ -73,6 +82,16 @@ if __name__ == '__main__':
     parser.add_argument('--socketio-port', type=int, help='port on which to provide the counterwalletd socket.io API')
     parser.add_argument('--socketio-chat-host', help='the interface on which to host the counterwalletd socket.io chat API')
     parser.add_argument('--socketio-chat-port', type=int, help='port on which to provide the counterwalletd socket.io chat API')
+    parser.add_argument('--eventfeed-endpoint', help='the ZeroMQ endpoint the blockfeed publishes message feed events on, for processes running the sio role without the feed role to subscribe to (e.g. ipc:///tmp/counterwalletd_eventfeed, or tcp://10.0.0.5:4103). Defaults to within this process only')
+    parser.add_argument('--messagefeed-buffer-size', type=int, help='the number of most recent message feed events to keep in memory, for clients catching up on what they missed (0 to disable)')
+    parser.add_argument('--event-log-blocks', type=int, help='the number of most recent blocks to keep message feed events for in the event log, for address activity queries (0 to disable)')
+
+    #BLOCKFEED TUNING
+    parser.add_argument('--blockfeed-prefetch-window', type=int, help='the number of upcoming blocks to fetch from counterpartyd ahead of the block being processed (when catching up)')
+    parser.add_argument('--blockfeed-range-fetch-size', type=int, help='the number of blocks to fetch from counterpartyd in a single request when far behind (0 to disable)')
+    parser.add_argument('--blockfeed-range-fetch-min-behind', type=int, help='how many blocks behind counterpartyd we must be before fetching blocks in ranges')
+    parser.add_argument('--blockfeed-bulk-flush-blocks', type=int, help='when catching up, the number of blocks whose writes are grouped into a single flush to mongo')
+    parser.add_argument('--blockfeed-undo-depth', type=int, help='the number of most recent blocks to keep undo records for (reorgs deeper than this take the slower full prune)')
 
     args = parser.parse_args()
 
@@ -99,6 +118,14 @@ if __name__ == '__main__':
         
     # reparse
     config.REPARSE_FORCED = args.reparse
+
+    # fast rebuild
+    if args.fast_rebuild:
+        config.FAST_REBUILD = args.fast_rebuild
+    elif has_config and configfile.has_option('Default', 'fast-rebuild'):
+        config.FAST_REBUILD = configfile.getboolean('Default', 'fast-rebuild')
+    else:
+        config.FAST_REBUILD = False
         
     ##############
     # THINGS WE CONNECT TO
@@ -146,6 +173,14 @@ if __name__ == '__main__':
     config.COUNTERPARTYD_RPC = 'http://' + config.COUNTERPARTYD_RPC_CONNECT + ':' + str(config.COUNTERPARTYD_RPC_PORT) + '/api/'
     config.COUNTERPARTYD_AUTH = HTTPBasicAuth(config.COUNTERPARTYD_RPC_USER, config.COUNTERPARTYD_RPC_PASSWORD) if (config.COUNTERPARTYD_RPC_USER and config.COUNTERPARTYD_RPC_PASSWORD) else None
 
+    # counterpartyd new block notification endpoint (optional)
+    if args.counterpartyd_zmq_connect:
+        config.COUNTERPARTYD_ZMQ_CONNECT = args.counterpartyd_zmq_connect
+    elif has_config and configfile.has_option('Default', 'counterpartyd-zmq-connect') and configfile.get('Default', 'counterpartyd-zmq-connect'):
+        config.COUNTERPARTYD_ZMQ_CONNECT = configfile.get('Default', 'counterpartyd-zmq-connect')
+    else:
+        config.COUNTERPARTYD_ZMQ_CONNECT = None
+
     # insight API host
     if args.insight_connect:
         config.INSIGHT_CONNECT = args.insight_connect
@@ -228,6 +263,14 @@ if __name__ == '__main__':
     else:
         config.REDIS_ENABLE_APICACHE = False
 
+    # redis-enable-presence
+    if args.redis_enable_presence:
+        config.REDIS_ENABLE_PRESENCE = args.redis_enable_presence
+    elif has_config and configfile.has_option('Default', 'redis-enable-presence') and configfile.get('Default', 'redis-enable-presence'):
+        config.REDIS_ENABLE_PRESENCE = configfile.getboolean('Default', 'redis-enable-presence')
+    else:
+        config.REDIS_ENABLE_PRESENCE = False
+
     # redis connect
     if args.redis_connect:
         config.REDIS_CONNECT = args.redis_connect
@@ -340,6 +383,126 @@ if __name__ == '__main__':
     except:
         raise Exception("Please specific a valid port number socketio-chat-port configuration parameter")
 
+    # message feed event publishing endpoint
+    if args.eventfeed_endpoint:
+        config.EVENTFEED_ENDPOINT = args.eventfeed_endpoint
+    elif has_config and configfile.has_option('Default', 'eventfeed-endpoint') and configfile.get('Default', 'eventfeed-endpoint'):
+        config.EVENTFEED_ENDPOINT = configfile.get('Default', 'eventfeed-endpoint')
+    else:
+        config.EVENTFEED_ENDPOINT = 'inproc://queue_eventfeed'
+    if config.EVENTFEED_ENDPOINT.split('://')[0] not in ('inproc', 'ipc', 'tcp'):
+        raise Exception("Please specific a valid eventfeed-endpoint configuration parameter (inproc://, ipc:// or tcp://)")
+
+    # roles to run in this process
+    if args.role:
+        config.ROLES = args.role
+    elif args.socketio_feed_only:
+        config.ROLES = 'sio'
+    elif has_config and configfile.has_option('Default', 'role') and configfile.get('Default', 'role'):
+        config.ROLES = configfile.get('Default', 'role')
+    else:
+        config.ROLES = ','.join(config.ALL_ROLES)
+    config.ROLES = [r.strip() for r in config.ROLES.split(',') if r.strip()]
+    if not config.ROLES or not set(config.ROLES).issubset(set(config.ALL_ROLES)):
+        raise Exception("Please specific a valid role configuration parameter (one or more of: %s)" % ', '.join(config.ALL_ROLES))
+    if 'sio' in config.ROLES and 'feed' not in config.ROLES and config.EVENTFEED_ENDPOINT.startswith('inproc://'):
+        raise Exception("Running the sio role without the feed role requires an ipc:// or tcp:// eventfeed-endpoint to subscribe to")
+
+    # message feed replay buffer size
+    if args.messagefeed_buffer_size is not None:
+        config.MESSAGEFEED_BUFFER_SIZE = args.messagefeed_buffer_size
+    elif has_config and configfile.has_option('Default', 'messagefeed-buffer-size') and configfile.get('Default', 'messagefeed-buffer-size'):
+        config.MESSAGEFEED_BUFFER_SIZE = configfile.get('Default', 'messagefeed-buffer-size')
+    else:
+        config.MESSAGEFEED_BUFFER_SIZE = 10000
+    try:
+        config.MESSAGEFEED_BUFFER_SIZE = int(config.MESSAGEFEED_BUFFER_SIZE)
+        assert int(config.MESSAGEFEED_BUFFER_SIZE) >= 0
+    except:
+        raise Exception("Please specific a valid messagefeed-buffer-size configuration parameter (0 or greater)")
+
+    # event log depth
+    if args.event_log_blocks is not None:
+        config.EVENT_LOG_BLOCKS = args.event_log_blocks
+    elif has_config and configfile.has_option('Default', 'event-log-blocks') and configfile.get('Default', 'event-log-blocks'):
+        config.EVENT_LOG_BLOCKS = configfile.get('Default', 'event-log-blocks')
+    else:
+        config.EVENT_LOG_BLOCKS = 2000
+    try:
+        config.EVENT_LOG_BLOCKS = int(config.EVENT_LOG_BLOCKS)
+        assert int(config.EVENT_LOG_BLOCKS) >= 0
+    except:
+        raise Exception("Please specific a valid event-log-blocks configuration parameter (0 or greater)")
+
+
+    ##############
+    # BLOCKFEED TUNING
+
+    # blockfeed prefetch window
+    if args.blockfeed_prefetch_window:
+        config.BLOCKFEED_PREFETCH_WINDOW = args.blockfeed_prefetch_window
+    elif has_config and configfile.has_option('Default', 'blockfeed-prefetch-window') and configfile.get('Default', 'blockfeed-prefetch-window'):
+        config.BLOCKFEED_PREFETCH_WINDOW = configfile.get('Default', 'blockfeed-prefetch-window')
+    else:
+        config.BLOCKFEED_PREFETCH_WINDOW = 10
+    try:
+        config.BLOCKFEED_PREFETCH_WINDOW = int(config.BLOCKFEED_PREFETCH_WINDOW)
+        assert int(config.BLOCKFEED_PREFETCH_WINDOW) >= 1
+    except:
+        raise Exception("Please specific a valid blockfeed-prefetch-window configuration parameter (1 or greater)")
+
+    # blockfeed range fetch size
+    if args.blockfeed_range_fetch_size is not None:
+        config.BLOCKFEED_RANGE_FETCH_SIZE = args.blockfeed_range_fetch_size
+    elif has_config and configfile.has_option('Default', 'blockfeed-range-fetch-size') and configfile.get('Default', 'blockfeed-range-fetch-size'):
+        config.BLOCKFEED_RANGE_FETCH_SIZE = configfile.get('Default', 'blockfeed-range-fetch-size')
+    else:
+        config.BLOCKFEED_RANGE_FETCH_SIZE = 250 #the max counterpartyd's get_blocks will return at once
+    try:
+        config.BLOCKFEED_RANGE_FETCH_SIZE = int(config.BLOCKFEED_RANGE_FETCH_SIZE)
+        assert int(config.BLOCKFEED_RANGE_FETCH_SIZE) >= 0
+    except:
+        raise Exception("Please specific a valid blockfeed-range-fetch-size configuration parameter (0 or greater)")
+
+    # blockfeed range fetch min behind
+    if args.blockfeed_range_fetch_min_behind is not None:
+        config.BLOCKFEED_RANGE_FETCH_MIN_BEHIND = args.blockfeed_range_fetch_min_behind
+    elif has_config and configfile.has_option('Default', 'blockfeed-range-fetch-min-behind') and configfile.get('Default', 'blockfeed-range-fetch-min-behind'):
+        config.BLOCKFEED_RANGE_FETCH_MIN_BEHIND = configfile.get('Default', 'blockfeed-range-fetch-min-behind')
+    else:
+        config.BLOCKFEED_RANGE_FETCH_MIN_BEHIND = 500
+    try:
+        config.BLOCKFEED_RANGE_FETCH_MIN_BEHIND = int(config.BLOCKFEED_RANGE_FETCH_MIN_BEHIND)
+        assert int(config.BLOCKFEED_RANGE_FETCH_MIN_BEHIND) >= 0
+    except:
+        raise Exception("Please specific a valid blockfeed-range-fetch-min-behind configuration parameter (0 or greater)")
+
+    # blockfeed bulk flush blocks
+    if args.blockfeed_bulk_flush_blocks:
+        config.BLOCKFEED_BULK_FLUSH_BLOCKS = args.blockfeed_bulk_flush_blocks
+    elif has_config and configfile.has_option('Default', 'blockfeed-bulk-flush-blocks') and configfile.get('Default', 'blockfeed-bulk-flush-blocks'):
+        config.BLOCKFEED_BULK_FLUSH_BLOCKS = configfile.get('Default', 'blockfeed-bulk-flush-blocks')
+    else:
+        config.BLOCKFEED_BULK_FLUSH_BLOCKS = 50
+    try:
+        config.BLOCKFEED_BULK_FLUSH_BLOCKS = int(config.BLOCKFEED_BULK_FLUSH_BLOCKS)
+        assert int(config.BLOCKFEED_BULK_FLUSH_BLOCKS) >= 1
+    except:
+        raise Exception("Please specific a valid blockfeed-bulk-flush-blocks configuration parameter (1 or greater)")
+
+    # blockfeed undo depth
+    if args.blockfeed_undo_depth:
+        config.BLOCKFEED_UNDO_DEPTH = args.blockfeed_undo_depth
+    elif has_config and configfile.has_option('Default', 'blockfeed-undo-depth') and configfile.get('Default', 'blockfeed-undo-depth'):
+        config.BLOCKFEED_UNDO_DEPTH = configfile.get('Default', 'blockfeed-undo-depth')
+    else:
+        config.BLOCKFEED_UNDO_DEPTH = 100
+    try:
+        config.BLOCKFEED_UNDO_DEPTH = int(config.BLOCKFEED_UNDO_DEPTH)
+        assert int(config.BLOCKFEED_UNDO_DEPTH) >= 1
+    except:
+        raise Exception("Please specific a valid blockfeed-undo-depth configuration parameter (1 or greater)")
+
 
     ##############
     # OTHER SETTINGS
@@ -402,69 +565,23 @@ if __name__ == '__main__':
         if not mongo_db.authenticate(config.MONGODB_USER, config.MONGODB_PASSWORD):
             raise Exception("Could not authenticate to mongodb with the supplied username and password.")
 
+    #snapshot export/import (one-shot modes, for bootstrapping new nodes)
+    if args.export_snapshot:
+        snapshot.export_snapshot(mongo_db, args.export_snapshot)
+        sys.exit(0)
+    if args.import_snapshot:
+        snapshot.import_snapshot(mongo_db, args.import_snapshot)
+        sys.exit(0)
+
+    if args.record_rpc:
+        logging.warn("Recording counterpartyd API responses to %s" % args.record_rpc)
+        util.rpc_recorder = mockcpd.RPCRecorder(args.record_rpc)
+
     #insert mongo indexes if need-be (i.e. for newly created database)
-    
-    ##COLLECTIONS THAT ARE PURGED AS A RESULT OF A REPARSE
-    #processed_blocks
-    mongo_db.processed_blocks.ensure_index('block_index', unique=True)
-    #tracked_assets
-    mongo_db.tracked_assets.ensure_index('asset', unique=True)
-    mongo_db.tracked_assets.ensure_index('_at_block') #for tracked asset pruning
-    mongo_db.tracked_assets.ensure_index([
-        ("owner", pymongo.ASCENDING),
-        ("asset", pymongo.ASCENDING),
-    ])
-    #trades
-    mongo_db.trades.ensure_index([
-        ("base_asset", pymongo.ASCENDING),
-        ("quote_asset", pymongo.ASCENDING),
-        ("block_time", pymongo.DESCENDING)
-    ])
-    mongo_db.trades.ensure_index([ #events.py and elsewhere (for singlular block_index index access)
-        ("block_index", pymongo.ASCENDING),
-        ("base_asset", pymongo.ASCENDING),
-        ("quote_asset", pymongo.ASCENDING)
-    ])
-
-    #balance_changes
-    mongo_db.balance_changes.ensure_index('block_index')
-    mongo_db.balance_changes.ensure_index([
-        ("address", pymongo.ASCENDING),
-        ("asset", pymongo.ASCENDING),
-        ("block_time", pymongo.ASCENDING)
-    ])
-    #asset_market_info
-    mongo_db.asset_market_info.ensure_index('asset', unique=True)
-    #asset_marketcap_history
-    mongo_db.asset_marketcap_history.ensure_index('block_index')
-    mongo_db.asset_marketcap_history.ensure_index([ #events.py
-        ("market_cap_as", pymongo.ASCENDING),
-        ("asset", pymongo.ASCENDING),
-        ("block_index", pymongo.DESCENDING)
-    ])
-    mongo_db.asset_marketcap_history.ensure_index([ #api.py
-        ("market_cap_as", pymongo.ASCENDING),
-        ("block_time", pymongo.DESCENDING)
-    ])
-    #btc_open_orders
-    mongo_db.btc_open_orders.ensure_index('when_created')
-    mongo_db.btc_open_orders.ensure_index('order_tx_hash', unique=True)
-    #asset_extended_info
-    mongo_db.asset_extended_info.ensure_index('asset', unique=True)
-    
-    ##COLLECTIONS THAT ARE *NOT* PURGED AS A RESULT OF A REPARSE
-    #preferences
-    mongo_db.preferences.ensure_index('wallet_id', unique=True)
-    mongo_db.preferences.ensure_index('last_touched')
-    #chat_handles
-    mongo_db.chat_handles.ensure_index('wallet_id', unique=True)
-    mongo_db.chat_handles.ensure_index('handle', unique=True)
-    #chat_history
-    mongo_db.chat_history.ensure_index('when')
-    mongo_db.chat_history.ensure_index([
-        ("handle", pymongo.ASCENDING),
-        ("when", pymongo.DESCENDING),
-    ])
+    #(secondary indexes on the collections purged as a result of a reparse are handled by the blockfeed, as
+    # they may be deferred until it is caught up, if doing a fast rebuild)
+    database.init_base_indexes(mongo_db)
+    database.init_nonpurged_indexes(mongo_db)
     
     #Connect to redis
     if config.REDIS_ENABLE_APICACHE:
@@ -472,37 +589,59 @@ if __name__ == '__main__':
         redis_client = redis.StrictRedis(host=config.REDIS_CONNECT, port=config.REDIS_PORT, db=config.REDIS_DATABASE)
     else:
         redis_client = None
+
+    #set up chat presence tracking
+    if config.REDIS_ENABLE_PRESENCE:
+        logging.info("Sharing chat presence through redis... (%s:%s)" % (config.REDIS_CONNECT, config.REDIS_PORT))
+        presence.init(presence.RedisPresenceBackend(
+            redis.StrictRedis(host=config.REDIS_CONNECT, port=config.REDIS_PORT, db=config.REDIS_DATABASE)))
+    else:
+        if 'api' in config.ROLES and 'chat' not in config.ROLES:
+            logging.warn("Not running the chat role, and presence is not shared (see --redis-enable-presence): order book online status will always be false")
+        presence.init(presence.LocalPresenceBackend())
     
-    #set up zeromq publisher for sending out received events to connected socket.io clients
     zmq_context = zmq.Context()
-    zmq_publisher_eventfeed = zmq_context.socket(zmq.PUB)
-    zmq_publisher_eventfeed.bind('inproc://queue_eventfeed')
-
-    logging.info("Starting up socket.io server (block event feed)...")
-    sio_server = socketio_server.SocketIOServer(
-        (config.SOCKETIO_HOST, config.SOCKETIO_PORT),
-        siofeeds.SocketIOMessagesFeedServer(zmq_context),
-        resource="socket.io", policy_server=False)
-    sio_server.start() #start the socket.io server greenlets
-
-    logging.info("Starting up socket.io server (counterwallet chat)...")
-    sio_server = socketio_server.SocketIOServer(
-        (config.SOCKETIO_CHAT_HOST, config.SOCKETIO_CHAT_PORT),
-        siofeeds.SocketIOChatFeedServer(mongo_db),
-        resource="socket.io", policy_server=False)
-    sio_server.start() #start the socket.io server greenlets
-
-    logging.info("Starting up counterpartyd block feed poller...")
-    gevent.spawn(blockfeed.process_cpd_blockfeed, mongo_db, zmq_publisher_eventfeed)
-
-    #start up event timers that don't depend on the feed being fully caught up
-    logging.debug("Starting event timer: expire_stale_prefs")
-    gevent.spawn(events.expire_stale_prefs, mongo_db)
-    logging.debug("Starting event timer: expire_stale_btc_open_order_records")
-    gevent.spawn(events.expire_stale_btc_open_order_records, mongo_db)
-
-    logging.info("Starting up RPC API handler...")
-    api.serve_api(mongo_db, redis_client)
+    logging.info("Running roles: %s" % ', '.join(config.ROLES))
+    if 'feed' in config.ROLES:
+        #set up zeromq publisher for sending out received events to connected socket.io clients
+        zmq_publisher_eventfeed = zmq_context.socket(zmq.PUB)
+        zmq_publisher_eventfeed.bind(config.EVENTFEED_ENDPOINT)
+    else:
+        #the blockfeed is running in another process: keep up with where it is at through the database
+        logging.info("Starting up blockfeed state follower...")
+        gevent.spawn(blockfeed.follow_blockfeed_state, mongo_db)
+
+    if 'sio' in config.ROLES:
+        logging.info("Starting up socket.io server (block event feed)...")
+        sio_server = socketio_server.SocketIOServer(
+            (config.SOCKETIO_HOST, config.SOCKETIO_PORT),
+            siofeeds.SocketIOMessagesFeedServer(zmq_context, mongo_db),
+            resource="socket.io", policy_server=False)
+        sio_server.start() #start the socket.io server greenlets
+
+    if 'chat' in config.ROLES:
+        logging.info("Starting up socket.io server (counterwallet chat)...")
+        sio_server = socketio_server.SocketIOServer(
+            (config.SOCKETIO_CHAT_HOST, config.SOCKETIO_CHAT_PORT),
+            siofeeds.SocketIOChatFeedServer(mongo_db),
+            resource="socket.io", policy_server=False)
+        sio_server.start() #start the socket.io server greenlets
+
+    if 'feed' in config.ROLES:
+        logging.info("Starting up counterpartyd block feed poller...")
+        gevent.spawn(blockfeed.process_cpd_blockfeed, mongo_db, zmq_context, zmq_publisher_eventfeed)
+
+        #start up event timers that don't depend on the feed being fully caught up
+        logging.debug("Starting event timer: expire_stale_prefs")
+        gevent.spawn(events.expire_stale_prefs, mongo_db)
+        logging.debug("Starting event timer: expire_stale_btc_open_order_records")
+        gevent.spawn(events.expire_stale_btc_open_order_records, mongo_db)
+
+    if 'api' in config.ROLES:
+        logging.info("Starting up RPC API handler...")
+        api.serve_api(mongo_db, redis_client)
+    else:
+        gevent.wait() #run until killed
 
 
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
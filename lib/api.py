@@ -18,9 +18,11 @@ import pymongo
 from bson import json_util
 from bson.son import SON
 
-from . import (config, siofeeds, util)
+from . import (config, presence, siofeeds, util, cache, blockfeed)
 
 PREFERENCES_MAX_LENGTH = 100000 #in bytes, as expressed in JSON
+MESSAGEFEED_SINCE_MAX_MESSAGES = 1000 #max number of messages get_messagefeed_messages_since will go to counterpartyd for
+ADDRESS_EVENTS_MAX_LIMIT = 1000 #max number of events get_address_events will return in one call
 D = decimal.Decimal
 
 
@@ -46,6 +48,11 @@ def serve_api(mongo_db, redis_client):
             'testnet': config.TESTNET 
         }
     
+    @dispatcher.add_method
+    def get_blockfeed_stats():
+        """Returns timing and throughput figures for the blockfeed (e.g. to see how a reparse is progressing)"""
+        return blockfeed.get_stats_summary()
+    
     @dispatcher.add_method
     def get_reflected_host_info():
         """Allows the requesting host to get some info about itself, such as its IP. Used for troubleshooting."""
@@ -57,10 +64,46 @@ def serve_api(mongo_db, redis_client):
     @dispatcher.add_method
     def get_messagefeed_messages_by_index(message_indexes): #yeah, dumb name :)
         messages = util.call_jsonrpc_api("get_messages_by_index", [message_indexes,], abort_on_error=True)['result']
-        events = []
-        for m in messages:
-            events.append(util.create_message_feed_obj_from_cpd_message(mongo_db, m))
-        return events
+        return util.create_message_feed_objs_from_cpd_messages(mongo_db, [(m, None) for m in messages])
+
+    @dispatcher.add_method
+    def get_messagefeed_messages_since(message_index):
+        """Returns the message feed events for all messages after message_index (i.e. the last message index a
+        client saw before it was disconnected). These come out of our buffer of recently published events if we
+        can (only kept when the blockfeed runs in this process), then the event log, otherwise from counterpartyd"""
+        events = cache.get_events_since(message_index)
+        if events is not None:
+            return events
+        last_message_index = config.LAST_MESSAGE_INDEX
+        if message_index >= last_message_index:
+            return []
+        if last_message_index - message_index > MESSAGEFEED_SINCE_MAX_MESSAGES:
+            raise Exception("Too many messages since message index %i (more than %i)" % (
+                message_index, MESSAGEFEED_SINCE_MAX_MESSAGES))
+        log_entries = list(mongo_db.event_log.find(
+            {'message_index': {'$gt': message_index, '$lte': last_message_index}},
+            {'_id': 0, 'event': 1}).sort("message_index", pymongo.ASCENDING))
+        if len(log_entries) == last_message_index - message_index: #the log has every message in the span
+            return [e['event'] for e in log_entries]
+        message_indexes = range(message_index + 1, last_message_index + 1)
+        messages = util.call_jsonrpc_api("get_messages_by_index", [message_indexes,], abort_on_error=True)['result']
+        return util.create_message_feed_objs_from_cpd_messages(mongo_db, [(m, None) for m in messages])
+
+    @dispatcher.add_method
+    def get_address_events(addresses, since_message_index=None, limit=100):
+        """Returns the message feed events involving any of the given addresses (oldest first), optionally only those
+        for messages after since_message_index. Only events for the blocks kept in the event log (the most recent
+        EVENT_LOG_BLOCKS blocks) are available"""
+        if not isinstance(addresses, list):
+            raise Exception("addresses must be a list of addresses, even if it just contains one address")
+        if not isinstance(limit, (int, long)) or isinstance(limit, bool) or not 1 <= limit <= ADDRESS_EVENTS_MAX_LIMIT:
+            raise Exception("limit must be an integer between 1 and %i" % ADDRESS_EVENTS_MAX_LIMIT)
+        query = {'addresses': {'$in': addresses}}
+        if since_message_index is not None:
+            query['message_index'] = {'$gt': since_message_index}
+        log_entries = mongo_db.event_log.find(query, {'_id': 0, 'event': 1}).sort(
+            "message_index", pymongo.ASCENDING).limit(limit)
+        return [e['event'] for e in log_entries]
 
     @dispatcher.add_method
     def get_btc_block_height():
@@ -133,12 +176,12 @@ def serve_api(mongo_db, redis_client):
         for d in result:
             if not d['quantity']:
                 continue #don't include balances with a zero asset value
-            asset_info = mongo_db.tracked_assets.find_one({'asset': d['asset']})
+            asset_info = cache.get_asset(mongo_db, d['asset'])
             d['normalized_quantity'] = util.normalize_quantity(d['quantity'], asset_info['divisible'])
             mappings[d['address'] + d['asset']] = d
             data.append(d)
         #include any owned assets for each address, even if their balance is zero
-        owned_assets = mongo_db.tracked_assets.find( { '$or': [{'owner': a } for a in addresses] }, { '_history': 0, '_id': 0 } )
+        owned_assets = mongo_db.tracked_assets.find( { '$or': [{'owner': a } for a in addresses] }, { '_id': 0 } )
         for o in owned_assets:
             if (o['owner'] + o['asset']) not in mappings:
                 data.append({
@@ -162,15 +205,6 @@ def serve_api(mongo_db, redis_client):
         @param limit: the maximum number of transactions to return; defaults to ten thousand
         @return: Returns the data, ordered from newest txn to oldest. If any limit is applied, it will cut back from the oldest results
         """
-        def get_asset_cached(asset, asset_cache):
-            if asset in asset_cache:
-                return asset_cache[asset]
-            asset_data = mongo_db.tracked_assets.find_one({'asset': asset})
-            asset_cache[asset] = asset_data
-            return asset_data
-        
-        asset_cache = {} #ghetto cache to speed asset lookups within the scope of a function call
-        
         if not end_ts: #default to current datetime
             end_ts = time.mktime(datetime.datetime.utcnow().timetuple())
         if not start_ts: #default to 30 days before the end date
@@ -190,19 +224,19 @@ def serve_api(mongo_db, redis_client):
                 continue
             if k in ['sends', 'callbacks']: #add asset divisibility info
                 for e in v:
-                    asset_info = get_asset_cached(e['asset'], asset_cache)
+                    asset_info = cache.get_asset(mongo_db, e['asset'])
                     e['_divisible'] = asset_info['divisible']
             if k in ['orders',]: #add asset divisibility info for both assets
                 for e in v:
-                    give_asset_info = get_asset_cached(e['give_asset'], asset_cache)
+                    give_asset_info = cache.get_asset(mongo_db, e['give_asset'])
                     e['_give_divisible'] = give_asset_info['divisible']
-                    get_asset_info = get_asset_cached(e['get_asset'], asset_cache)
+                    get_asset_info = cache.get_asset(mongo_db, e['get_asset'])
                     e['_get_divisible'] = get_asset_info['divisible']
             if k in ['order_matches',]: #add asset divisibility info for both assets
                 for e in v:
-                    forward_asset_info = get_asset_cached(e['forward_asset'], asset_cache)
+                    forward_asset_info = cache.get_asset(mongo_db, e['forward_asset'])
                     e['_forward_divisible'] = forward_asset_info['divisible']
-                    backward_asset_info = get_asset_cached(e['backward_asset'], asset_cache)
+                    backward_asset_info = cache.get_asset(mongo_db, e['backward_asset'])
                     e['_backward_divisible'] = backward_asset_info['divisible']
             if k in ['bet_expirations', 'order_expirations', 'bet_match_expirations', 'order_match_expirations']:
                 for e in v:
@@ -223,8 +257,8 @@ def serve_api(mongo_db, redis_client):
         """Given two arbitrary assets, returns the base asset and the quote asset.
         """
         base_asset, quote_asset = util.assets_to_asset_pair(asset1, asset2)
-        base_asset_info = mongo_db.tracked_assets.find_one({'asset': base_asset})
-        quote_asset_info = mongo_db.tracked_assets.find_one({'asset': quote_asset})
+        base_asset_info = cache.get_asset(mongo_db, base_asset)
+        quote_asset_info = cache.get_asset(mongo_db, quote_asset)
         pair_name = "%s/%s" % (base_asset, quote_asset)
 
         if not base_asset_info or not quote_asset_info:
@@ -458,8 +492,8 @@ def serve_api(mongo_db, redis_client):
         @param: normalized_fee_provided: Only specify if selling BTC. If specified, the order book will be pruned down to only
          show orders at and above this fee_provided
         """
-        base_asset_info = mongo_db.tracked_assets.find_one({'asset': base_asset})
-        quote_asset_info = mongo_db.tracked_assets.find_one({'asset': quote_asset})
+        base_asset_info = cache.get_asset(mongo_db, base_asset)
+        quote_asset_info = cache.get_asset(mongo_db, quote_asset)
         
         if not base_asset_info or not quote_asset_info:
             raise Exception("Invalid asset(s)")
@@ -594,10 +628,16 @@ def serve_api(mongo_db, redis_client):
             o['block_time'] = time.mktime(util.get_block_time(mongo_db, o['block_index']).timetuple()) * 1000
             
         #for orders where BTC is the give asset, also return online status of the user (if they are using counterwallet)
+        btc_order_wallet_ids = {} #key = order tx_hash, value = wallet ID
+        btc_order_tx_hashes = [o['tx_hash'] for o in orders if o['give_asset'] == 'BTC']
+        if btc_order_tx_hashes:
+            for r in mongo_db.btc_open_orders.find({'order_tx_hash': {'$in': btc_order_tx_hashes}},
+              {'_id': 0, 'order_tx_hash': 1, 'wallet_id': 1}):
+                btc_order_wallet_ids[r['order_tx_hash']] = r['wallet_id']
+        online_wallet_ids = presence.get_online(btc_order_wallet_ids.values())
         for o in orders:
             if o['give_asset'] == 'BTC':
-                r = mongo_db.btc_open_orders.find_one({'order_tx_hash': o['tx_hash']})
-                o['_is_online'] = (r['wallet_id'] in siofeeds.onlineClients) if r else False
+                o['_is_online'] = btc_order_wallet_ids.get(o['tx_hash'], None) in online_wallet_ids
             else:
                 o['_is_online'] = None #does not apply in this case
 
@@ -716,13 +756,15 @@ def serve_api(mongo_db, redis_client):
         * IF type = 'called_back':
           * 'percentage': The percentage of the asset called back (between 0 and 100)
         """
-        asset = mongo_db.tracked_assets.find_one({ 'asset': asset }, {"_id":0})
+        asset = cache.get_asset(mongo_db, asset)
         if not asset:
             raise Exception("Unrecognized asset")
         
-        #run down through _history and compose a diff log
+        #run down through the asset's prior versions and compose a diff log
         history = []
-        raw = asset['_history'] + [asset,] #oldest to newest. add on the current state
+        raw = list(mongo_db.tracked_asset_history.find({'asset': asset['asset']}, {'_id': 0}).sort(
+            [("_at_block", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)]))
+        raw.append(asset) #oldest to newest. add on the current state
         prev = None
         for i in xrange(len(raw)): #oldest to newest
             if i == 0:
@@ -835,7 +877,7 @@ def serve_api(mongo_db, redis_client):
         if not isinstance(addresses, list):
             raise Exception("addresses must be a list of addresses, even if it just contains one address")
             
-        asset_info = mongo_db.tracked_assets.find_one({'asset': asset})
+        asset_info = cache.get_asset(mongo_db, asset)
         if not asset_info:
             raise Exception("Asset does not exist.")
             
@@ -864,8 +906,9 @@ def serve_api(mongo_db, redis_client):
 
     @dispatcher.add_method
     def is_chat_handle_in_use(handle):
-        results = mongo_db.chat_handles.find({ 'handle': { '$regex': '^%s$' % handle, '$options': 'i' } })
-        return True if results.count() else False 
+        if not isinstance(handle, basestring):
+            raise Exception("Invalid chat handle: bad data type")
+        return mongo_db.chat_handles.find_one({'handle_lower': handle.lower()}, {'_id': 1}) is not None
 
     @dispatcher.add_method
     def get_chat_handle(wallet_id):
@@ -894,19 +937,23 @@ def serve_api(mongo_db, redis_client):
             raise Exception("Invalid chat handle: bad syntax/length")
         
         #see if this handle already exists (case insensitive)
-        results = mongo_db.chat_handles.find({ 'handle': { '$regex': '^%s$' % handle, '$options': 'i' } })
-        if results.count():
+        if mongo_db.chat_handles.find_one({'handle_lower': handle.lower()}, {'_id': 1}):
             raise Exception("Chat handle already is in use")
 
-        mongo_db.chat_handles.update(
-            {'wallet_id': wallet_id},
-            {"$set": {
-                'wallet_id': wallet_id,
-                'handle': handle,
-                'last_updated': time.mktime(time.gmtime()),
-                'last_touched': time.mktime(time.gmtime()) 
-                }
-            }, upsert=True)
+        try:
+            mongo_db.chat_handles.update(
+                {'wallet_id': wallet_id},
+                {"$set": {
+                    'wallet_id': wallet_id,
+                    'handle': handle,
+                    'handle_lower': handle.lower(),
+                    'last_updated': time.mktime(time.gmtime()),
+                    'last_touched': time.mktime(time.gmtime()) 
+                    }
+                }, upsert=True)
+        except pymongo.errors.DuplicateKeyError: #someone else just took it
+            raise Exception("Chat handle already is in use")
+        siofeeds.set_cached_chat_handle(wallet_id, handle) #(for a chat server running in this process)
         #^ last_updated MUST be in UTC, as it will be compaired again other servers
         return True
 
@@ -11,28 +11,432 @@ import datetime
 import decimal
 import ConfigParser
 import time
+import collections
 
 import pymongo
 import gevent
+import gevent.queue
+import zmq.green as zmq
+from bson.objectid import ObjectId
 
-from lib import (config, util, events)
+from lib import (config, util, events, database, migrations, cache)
 
 D = decimal.Decimal
+STATE_POLL_INTERVAL = 1 #seconds between checks of the blockfeed state by processes not running the blockfeed
 
 
-def process_cpd_blockfeed(mongo_db, zmq_publisher_eventfeed):
+class BlockPrefetcher(object):
+    """Keeps a bounded window of upcoming blocks (block info plus messages) in flight from counterpartyd, so that
+    the fetching of the next blocks overlaps with the processing of the current one. Blocks are still handed out
+    (and thus processed) strictly in order.
+    
+    When we are far behind counterpartyd (i.e. when reparsing), whole spans of blocks are pulled down in one request
+    via get_blocks, to avoid paying for two RPC round-trips per block. Near the tip we fall back to fetching a
+    single block at a time."""
+    def __init__(self, window_size, range_size=0, range_min_behind=0):
+        self.window_size = window_size
+        self.range_size = range_size #0 to disable range fetching
+        self.range_min_behind = range_min_behind
+        self._pending = {} #key = block_index, value = greenlet fetching the data for that block (may span blocks)
+
+    def _fetch(self, block_index):
+        block_info = util.call_jsonrpc_api("get_block_info", [block_index,], abort_on_error=True)['result']
+        messages = util.call_jsonrpc_api("get_messages", [block_index,], abort_on_error=True)['result']
+        return {block_index: (block_info, messages)}
+
+    def _fetch_range(self, block_indexes):
+        result = util.call_jsonrpc_api("get_blocks", [block_indexes,])
+        if 'error' in result:
+            if result['error'].get('code', None) == -32601: #method not found (i.e. an older counterpartyd)
+                logging.warn("counterpartyd does not support get_blocks. Disabling range fetching...")
+                self.range_size = 0
+            raise Exception("Got back error from server: %s" % result['error'])
+        #split the blocks out locally, each with its own list of messages
+        data = {}
+        for block in result['result']:
+            messages = block.pop('_messages')
+            data[block['block_index']] = (block, messages)
+        return data
+
+    def get(self, block_index, last_block_index):
+        """Returns a (block_info, messages) tuple for the given block, and tops up the window of in-flight fetches
+        (up to last_block_index, which is the last block counterpartyd has processed). Raises an exception if the
+        fetch for the block failed (in that case, the fetch will be retried the next time the block is requested)"""
+        self.discard(below_block_index=block_index) #we have moved past these
+        range_mode = self.range_size and last_block_index - block_index > self.range_min_behind
+        if range_mode:
+            end_block_index = min(block_index + (2 * self.range_size) - 1, last_block_index) #current span plus the next
+        else:
+            end_block_index = min(block_index + self.window_size - 1, last_block_index)
+        i = block_index
+        while i <= end_block_index:
+            if i in self._pending:
+                i += 1
+                continue
+            if range_mode:
+                span = []
+                while i <= last_block_index and len(span) < self.range_size and i not in self._pending:
+                    span.append(i)
+                    i += 1
+                fetch = gevent.spawn(self._fetch_range, span)
+                for j in span:
+                    self._pending[j] = fetch
+            else:
+                self._pending[i] = gevent.spawn(self._fetch, i)
+                i += 1
+        fetch = self._pending.pop(block_index, None)
+        if fetch is None: #i.e. block_index is past last_block_index
+            fetch = gevent.spawn(self._fetch, block_index)
+        fetch.join()
+        if not fetch.successful():
+            self.discard(fetch=fetch) #so that the blocks this covered get fetched again
+            raise fetch.exception
+        if block_index not in fetch.value:
+            raise Exception("counterpartyd did not return block %i" % block_index)
+        return fetch.value[block_index]
+
+    def discard(self, below_block_index=None, fetch=None):
+        """Throws away prefetched data (e.g. after a reorg). If below_block_index is specified, only throw away data
+        for blocks before that block index. If fetch is specified, only throw away data from that fetch"""
+        discarded = set()
+        for block_index in self._pending.keys():
+            if below_block_index is not None and block_index >= below_block_index:
+                continue
+            if fetch is not None and self._pending[block_index] is not fetch:
+                continue
+            discarded.add(self._pending.pop(block_index))
+        still_needed = set(self._pending.values())
+        for g in discarded - still_needed:
+            g.kill(block=False)
+
+
+class WriteBatch(object):
+    """Collects the writes the blockfeed makes to its derived collections for one or more blocks, and flushes them
+    to mongo as ordered bulk operations (one per collection). processed_blocks records are always written last, and
+    act as the commit point for the blocks in the batch: if we die partway through a flush, the blocks without a
+    processed_blocks record are pruned on startup like any other partially processed block. block_undo records are
+    always written first, so that any data we have written for a block can be rolled back. The collections in
+    between don't depend on each other, so their bulk operations are run concurrently."""
+    COMMIT_COLLECTION = 'processed_blocks'
+    UNDO_COLLECTION = 'block_undo'
+    
+    def __init__(self, mongo_db):
+        self.mongo_db = mongo_db
+        self.clear()
+
+    def clear(self):
+        self._ops = {} #key = collection name, value = list of ops, in the order they were made
+        self._collection_order = [] #so that collections are flushed in the order they were first written to
+        self.num_blocks = 0 #number of blocks committed in this batch
+        self.last_block_index = None #the last block committed in this batch
+
+    def _add(self, collection, op):
+        if collection not in self._ops:
+            self._ops[collection] = []
+            self._collection_order.append(collection)
+        self._ops[collection].append(op)
+
+    def insert(self, collection, doc):
+        if '_id' not in doc:
+            doc['_id'] = ObjectId() #assign now, so that later ops in the batch can reference the record
+        self._add(collection, ('insert', dict(doc)))
+        #^ a copy of the record as it is now, so that later changes the caller makes to it in memory (which are made
+        # through their own update ops, e.g. an $inc on a same-block balance change) are not written twice
+
+    def update(self, collection, spec, document, upsert=False, multi=False):
+        self._add(collection, ('update', spec, document, upsert, multi))
+
+    def remove(self, collection, spec):
+        self._add(collection, ('remove', spec))
+
+    def commit_block(self, block, undo_ops=None):
+        """marks the end of a block's writes (written after everything else in the batch). If undo_ops is specified,
+        an undo record is written for the block as well (before everything else in the batch)"""
+        if undo_ops is not None:
+            self.insert(self.UNDO_COLLECTION, {'block_index': block['block_index'], 'ops': undo_ops})
+        self.insert(self.COMMIT_COLLECTION, block)
+        self.num_blocks += 1
+        self.last_block_index = block['block_index']
+
+    def _flush_collection(self, collection):
+        bulk = self.mongo_db[collection].initialize_ordered_bulk_op()
+        for op in self._ops[collection]:
+            if op[0] == 'insert':
+                bulk.insert(op[1])
+            elif op[0] == 'update':
+                selector = bulk.find(op[1]).upsert() if op[3] else bulk.find(op[1])
+                if op[4]: selector.update(op[2])
+                else: selector.update_one(op[2])
+            else:
+                assert op[0] == 'remove'
+                bulk.find(op[1]).remove()
+        bulk.execute()
+
+    def flush(self):
+        if self.UNDO_COLLECTION in self._ops:
+            self._flush_collection(self.UNDO_COLLECTION)
+        flushes = [gevent.spawn(self._flush_collection, c) for c in self._collection_order
+            if c not in (self.UNDO_COLLECTION, self.COMMIT_COLLECTION)]
+        gevent.joinall(flushes, raise_error=True)
+        if self.COMMIT_COLLECTION in self._ops:
+            self._flush_collection(self.COMMIT_COLLECTION)
+        self.clear()
+
+
+class BlockfeedStats(object):
+    """Keeps timings and throughput figures for the blockfeed, to show where the time goes while catching up.
+    Per-block timings are kept for a rolling window of the most recently processed blocks, broken down into:
+    fetch (waiting on block data from counterpartyd), issuances, balances (credits and debits), trades (order
+    matches), events (building message feed events) and writes (flushing to mongo)."""
+    CATEGORIES = ('fetch', 'issuances', 'balances', 'trades', 'events', 'writes')
+    WINDOW_SIZE = 1000 #number of most recent blocks throughput and average timings are figured over
+    LOG_INTERVAL = 30 #seconds between summary log lines
+    
+    def __init__(self):
+        self._window = collections.deque(maxlen=self.WINDOW_SIZE) #(end time, num messages, timings) per block
+        self._cur_timings = dict.fromkeys(self.CATEGORIES, 0.0) #timings for the block being processed
+        self._window_start = None #when the block before the first in the window finished
+        self._last_logged = time.time()
+        self.num_blocks = 0 #totals since we started up
+        self.num_messages = 0
+        self.block_index = None #last block processed
+        self.last_block_index = None #last block processed by counterpartyd (i.e. where we are catching up to)
+    
+    def add_time(self, category, seconds):
+        self._cur_timings[category] += seconds
+    
+    def end_block(self, block_index, last_block_index, num_messages):
+        """records the end of processing for a block"""
+        now = time.time()
+        if len(self._window) == self._window.maxlen:
+            self._window_start = self._window[0][0] #the block about to drop out of the window
+        elif self._window_start is None:
+            self._window_start = now - sum(self._cur_timings.values())
+        self._window.append((now, num_messages, self._cur_timings))
+        self._cur_timings = dict.fromkeys(self.CATEGORIES, 0.0)
+        self.num_blocks += 1
+        self.num_messages += num_messages
+        self.block_index = block_index
+        self.last_block_index = last_block_index
+        if now - self._last_logged >= self.LOG_INTERVAL:
+            self.log_summary()
+            self._last_logged = now
+    
+    def get_summary(self):
+        elapsed = (self._window[-1][0] - self._window_start) if self._window else 0
+        blocks_per_sec = len(self._window) / elapsed if elapsed else None
+        messages_per_sec = sum([b[1] for b in self._window]) / elapsed if elapsed else None
+        blocks_behind = (self.last_block_index - self.block_index) if self.block_index is not None else None
+        avg_timings = {}
+        for category in self.CATEGORIES:
+            avg_timings[category] = (1000.0 * sum([b[2][category] for b in self._window]) / len(self._window)) \
+                if self._window else None
+        return {
+            'block_index': self.block_index,
+            'last_block_index': self.last_block_index,
+            'blocks_behind': blocks_behind,
+            'blocks_per_sec': blocks_per_sec,
+            'messages_per_sec': messages_per_sec,
+            'eta_seconds': blocks_behind / blocks_per_sec if blocks_behind and blocks_per_sec else 0,
+            'avg_block_timings_ms': avg_timings, #over the last WINDOW_SIZE blocks
+            'window_blocks': len(self._window),
+            'total_blocks': self.num_blocks, #since startup
+            'total_messages': self.num_messages,
+        }
+    
+    def log_summary(self):
+        summary = self.get_summary()
+        if not summary['blocks_per_sec']:
+            return
+        logging.info("Blockfeed: block %i of %i (%i behind) :: %.2f blocks/sec, %.1f msgs/sec, ETA %s :: avg ms/block: %s" % (
+            summary['block_index'], summary['last_block_index'], summary['blocks_behind'],
+            summary['blocks_per_sec'], summary['messages_per_sec'],
+            datetime.timedelta(seconds=int(summary['eta_seconds'])),
+            ', '.join(["%s=%.1f" % (c, summary['avg_block_timings_ms'][c]) for c in self.CATEGORIES])))
+
+stats = BlockfeedStats()
+
+
+class NewBlockWaiter(object):
+    """Waits between checks of counterpartyd for new blocks once we are caught up. If counterpartyd (or a stand-in)
+    publishes a notification over ZeroMQ when it processes a block (any message will do), we wake up as soon as it
+    arrives. Either way, we also poll, backing off while nothing is happening (with notifications, polling is
+    just a fallback in case one is missed, so it backs off much further)."""
+    POLL_INTERVAL_MIN = 0.5 #seconds
+    POLL_INTERVAL_MAX = 2
+    POLL_INTERVAL_MAX_NOTIFIED = 30
+    
+    def __init__(self, zmq_context, connect=None):
+        self.socket = None
+        if connect:
+            self.socket = zmq_context.socket(zmq.SUB)
+            self.socket.setsockopt(zmq.SUBSCRIBE, "")
+            self.socket.connect(connect)
+            self.poller = zmq.Poller()
+            self.poller.register(self.socket, zmq.POLLIN)
+            logging.info("Listening for new block notifications from counterpartyd at %s" % connect)
+        self.poll_interval = self.POLL_INTERVAL_MIN
+    
+    def reset(self):
+        """called when we find new blocks (i.e. so the next wait is short)"""
+        self.poll_interval = self.POLL_INTERVAL_MIN
+    
+    def wait(self):
+        """waits until notified of a new block, or until it is time to poll again. Returns True if notified"""
+        notified = False
+        if self.socket is None:
+            time.sleep(self.poll_interval)
+        elif self.poller.poll(self.poll_interval * 1000):
+            notified = True
+            while True: #drain any notifications that piled up (we only need to check once)
+                try:
+                    self.socket.recv(zmq.NOBLOCK)
+                except zmq.ZMQError:
+                    break
+        self.poll_interval = min(self.poll_interval * 2,
+            self.POLL_INTERVAL_MAX if self.socket is None else self.POLL_INTERVAL_MAX_NOTIFIED)
+        return notified
+
+
+class BlockfeedWorker(object):
+    """Handles one category of the blockfeed's derived state (e.g. balances, or trades) in its own greenlet, working
+    through the messages handed to it in the order they were put, and timing itself under that category in the
+    blockfeed stats. join() is the per-block barrier: it waits until the worker is through everything handed to it
+    so far, and re-raises the first exception the handler hit."""
+    def __init__(self, category, handler):
+        self.category = category
+        self.handler = handler
+        self.queue = gevent.queue.JoinableQueue()
+        self._exc_info = None
+        self.greenlet = gevent.spawn(self._run)
+
+    def _run(self):
+        while True:
+            args = self.queue.get()
+            start = time.time()
+            try:
+                self.handler(*args)
+            except Exception:
+                logging.exception("Blockfeed %s worker failed" % self.category)
+                if self._exc_info is None:
+                    self._exc_info = sys.exc_info()
+            else:
+                stats.add_time(self.category, time.time() - start)
+            finally:
+                self.queue.task_done()
+
+    def put(self, *args):
+        """queues a call to the handler with the given arguments"""
+        self.queue.put(args)
+
+    def join(self):
+        self.queue.join()
+        if self._exc_info is not None:
+            exc_info, self._exc_info = self._exc_info, None
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+
+_published_state = {} #the blockfeed state we last recorded in the database
+_state_epoch = None #changes whenever the blockfeed rolls back or rebuilds its derived state
+_followed_state = None #the blockfeed state we last read from the database (if the blockfeed runs in another process)
+
+
+def publish_blockfeed_state(mongo_db, new_epoch=False):
+    """records where the blockfeed is at in the database (if that has changed since we last recorded it), for
+    processes running the other roles to follow. If new_epoch is specified, the derived state was just rolled back
+    or rebuilt, and followers should reload their caches"""
+    global _state_epoch
+    if new_epoch or _state_epoch is None:
+        _state_epoch = time.time()
+    state = {
+        'current_block_index': config.CURRENT_BLOCK_INDEX,
+        'last_message_index': config.LAST_MESSAGE_INDEX,
+        'caught_up': config.CAUGHT_UP,
+        'insight_last_block': config.INSIGHT_LAST_BLOCK,
+        'secondary_indexes_built': config.SECONDARY_INDEXES_BUILT,
+        'state_epoch': _state_epoch,
+        'stats': stats.get_summary(),
+    }
+    if state != _published_state:
+        mongo_db.blockfeed_state.update({}, {'$set': state}, upsert=True)
+        _published_state.clear()
+        _published_state.update(state)
+
+
+def follow_blockfeed_state(mongo_db):
+    """run in processes that don't run the blockfeed (i.e. without the feed role): keeps our view of where the
+    blockfeed is at (config.CURRENT_BLOCK_INDEX, CAUGHT_UP, etc), and our caches of the state it derives, in step
+    with what the blockfeed process records in the database"""
+    global _followed_state
+    config.CURRENT_BLOCK_INDEX = 0
+    config.LAST_MESSAGE_INDEX = -1
+    config.CAUGHT_UP = False
+    config.INSIGHT_LAST_BLOCK = 0
+    state_epoch = None
+    while True:
+        try:
+            state = mongo_db.blockfeed_state.find_one()
+            if state:
+                if state['state_epoch'] != state_epoch or state['current_block_index'] < config.CURRENT_BLOCK_INDEX:
+                    #blockfeed (re)started, rolled back or rebuilt: start over
+                    cache.load_assets(mongo_db)
+                    cache.load_block_times(mongo_db)
+                    state_epoch = state['state_epoch']
+                elif state['current_block_index'] > config.CURRENT_BLOCK_INDEX:
+                    #pick up what changed in the blocks since we last looked
+                    for asset_info in mongo_db.tracked_assets.find(
+                      {'_at_block': {'$gt': config.CURRENT_BLOCK_INDEX}}, {'_id': 0}):
+                        cache.set_asset(asset_info)
+                    last_block_index = cache.get_last_block_time_index()
+                    for block in mongo_db.processed_blocks.find(
+                      {'block_index': {'$gt': last_block_index if last_block_index is not None else -1}},
+                      {'_id': 0, 'block_index': 1, 'block_time': 1}).sort("block_index", pymongo.ASCENDING):
+                        cache.append_block_time(block['block_index'], block['block_time'])
+                config.CURRENT_BLOCK_INDEX = state['current_block_index']
+                config.LAST_MESSAGE_INDEX = state['last_message_index']
+                config.CAUGHT_UP = state['caught_up']
+                config.INSIGHT_LAST_BLOCK = state['insight_last_block']
+                config.SECONDARY_INDEXES_BUILT = state['secondary_indexes_built']
+                _followed_state = state
+        except Exception, e:
+            logging.warn("Could not update the blockfeed state: %s" % e)
+        time.sleep(STATE_POLL_INTERVAL)
+
+
+def get_stats_summary():
+    """Returns the blockfeed stats summary (as last recorded by the blockfeed process, if it runs in another one)"""
+    if _followed_state is not None:
+        return _followed_state.get('stats', None)
+    return stats.get_summary()
+
+
+def process_cpd_blockfeed(mongo_db, zmq_context, zmq_publisher_eventfeed):
+    INSIGHT_CHECK_INTERVAL = 10 #seconds
     LATEST_BLOCK_INIT = {'block_index': config.BLOCK_FIRST, 'block_time': None, 'block_hash': None}
+    LAST_BALANCE_FIELDS = {'address': 1, 'asset': 1, 'block_index': 1, 'new_balance': 1, 'new_balance_normalized': 1}
+    last_balances = {} #key = (address, asset), value = the last balance_changes record for that pair
+    #^ kept in sync with balance_changes as we go, so that we never have to read the previous balance from mongo
 
     def blow_away_db():
         #boom! blow away all collections in mongo
         mongo_db.processed_blocks.drop()
+        mongo_db.block_undo.drop()
         mongo_db.tracked_assets.drop()
+        mongo_db.tracked_asset_history.drop()
         mongo_db.trades.drop()
         mongo_db.balance_changes.drop()
         mongo_db.asset_market_info.drop()
         mongo_db.asset_marketcap_history.drop()
         mongo_db.btc_open_orders.drop()
         mongo_db.asset_extended_info.drop()
+        mongo_db.event_log.drop()
+        
+        #recreate the indexes we dropped. on a fast rebuild, only create those the blockfeed needs to function,
+        # and build the rest in one go once we are caught up
+        database.init_base_indexes(mongo_db)
+        if not config.FAST_REBUILD:
+            database.init_secondary_indexes(mongo_db)
+        config.SECONDARY_INDEXES_BUILT = not config.FAST_REBUILD
         
         #create/update default app_config object
         mongo_db.app_config.update({}, {
@@ -42,6 +446,7 @@ def process_cpd_blockfeed(mongo_db, zmq_publisher_eventfeed):
         'counterpartyd_db_version_minor': None,
         'counterpartyd_running_testnet': None,
         'last_block_assets_compiled': config.BLOCK_FIRST, #for asset data compilation in events.py (resets on reparse as well)
+        'secondary_indexes_built': config.SECONDARY_INDEXES_BUILT, #False while doing a fast rebuild
         }, upsert=True)
         app_config = mongo_db.app_config.find()[0]
         
@@ -56,13 +461,18 @@ def process_cpd_blockfeed(mongo_db, zmq_publisher_eventfeed):
                 'locked': False,
                 'total_issued': None,
                 '_at_block': config.BLOCK_FIRST, #the block ID this asset is current for
-                '_history': [] #to allow for block rollbacks
             }
             mongo_db.tracked_assets.insert(base_asset)
+        cache.load_assets(mongo_db)
+        cache.clear_block_times()
             
         #reinitialize some internal counters
         config.CURRENT_BLOCK_INDEX = 0
         config.LAST_MESSAGE_INDEX = -1
+        publish_blockfeed_state(mongo_db, new_epoch=True)
+        last_balances.clear()
+        batch.clear() #anything pending is for the state we just blew away
+        del pending_events[:]
         
         return app_config
         
@@ -74,38 +484,370 @@ def process_cpd_blockfeed(mongo_db, zmq_publisher_eventfeed):
         (which will get a new last_processed_block from counterpartyd and resume as appropriate)   
         """
         logging.warn("Pruning to block %i ..." % (max_block_index))        
+        prefetcher.discard() #anything prefetched past this point may be from the orphaned chain
+        join_workers()
+        flush_batch() #get everything we have pending into mongo, so that it is pruned along with the rest
+        
+        #if we have undo records for every block we are pruning, replay them to roll back exactly what was changed.
+        # (the range-based cleanup below then finds nothing left to do, save for any blocks whose data was written
+        # without an undo record, such as those processed deep in catch-up, or before we kept undo records)
+        undo_records = list(mongo_db.block_undo.find(
+            {"block_index": {"$gt": max_block_index}}).sort("block_index", pymongo.DESCENDING))
+        stale_block_indexes = set([b['block_index'] for b in mongo_db.processed_blocks.find(
+            {"block_index": {"$gt": max_block_index}}, {'block_index': 1})])
+        pruned_assets = set()
+        if stale_block_indexes.issubset(set([r['block_index'] for r in undo_records])):
+            pruned_assets = undo_blocks(undo_records)
+        else:
+            logging.warn("Missing undo records for some blocks past %i. Falling back to a full prune..." % max_block_index)
+        mongo_db.block_undo.remove({"block_index": {"$gt": max_block_index}})
+        
         mongo_db.processed_blocks.remove({"block_index": {"$gt": max_block_index}})
+        cache.truncate_block_times(max_block_index)
+        cache.clear_events() #message indexes go back after a reorg
+        pruned_balance_pairs = set([(b['address'], b['asset']) for b in mongo_db.balance_changes.find(
+            {"block_index": {"$gt": max_block_index}}, {'_id': 0, 'address': 1, 'asset': 1})])
         mongo_db.balance_changes.remove({"block_index": {"$gt": max_block_index}})
+        #roll back our last balance index for the (address, asset) pairs whose balances changed in the pruned blocks
+        for address, asset in pruned_balance_pairs:
+            last_bal_change = mongo_db.balance_changes.find_one({'address': address, 'asset': asset},
+                LAST_BALANCE_FIELDS, sort=[("block_index", pymongo.DESCENDING)])
+            if last_bal_change:
+                last_balances[(address, asset)] = last_bal_change
+            else:
+                last_balances.pop((address, asset), None)
         mongo_db.trades.remove({"block_index": {"$gt": max_block_index}})
         mongo_db.asset_marketcap_history.remove({"block_index": {"$gt": max_block_index}})
+        mongo_db.event_log.remove({"block_index": {"$gt": max_block_index}})
         
-        #to roll back the state of the tracked asset, dive into the history object for each asset that has
+        #to roll back the state of the tracked asset, dive into the history for each asset that has
         # been updated on or after the block that we are pruning back to
         assets_to_prune = mongo_db.tracked_assets.find({'_at_block': {"$gt": max_block_index}})
         for asset in assets_to_prune:
             logging.info("Pruning asset %s (last modified @ block %i, pruning to state at block %i)" % (
                 asset['asset'], asset['_at_block'], max_block_index))
-            prev_ver = None
-            while len(asset['_history']):
-                prev_ver = asset['_history'].pop()
-                if prev_ver['_at_block'] <= max_block_index:
-                    break
-            if prev_ver:
-                if prev_ver['_at_block'] > max_block_index:
-                    #even the first history version is newer than max_block_index.
-                    #in this case, just remove the asset tracking record itself
-                    mongo_db.tracked_assets.remove({'asset': asset['asset']})
-                else:
-                    #if here, we were able to find a previous version that was saved at or before max_block_index
-                    # (which should be prev_ver ... restore asset's values to its values
-                    prev_ver['_id'] = asset['_id']
-                    prev_ver['_history'] = asset['_history']
-                    mongo_db.tracked_assets.save(prev_ver)
+            pruned_assets.add(asset['asset'])
+            #the version current as of max_block_index is the first one that was superseded after it
+            prev_ver = mongo_db.tracked_asset_history.find_one(
+                {'asset': asset['asset'], '_superseded_at_block': {"$gt": max_block_index}},
+                sort=[("_superseded_at_block", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)])
+            if not prev_ver or prev_ver['_at_block'] > max_block_index:
+                #even the first version is newer than max_block_index.
+                #in this case, just remove the asset tracking record itself
+                mongo_db.tracked_assets.remove({'asset': asset['asset']})
+            else:
+                #if here, we were able to find a previous version that was saved at or before max_block_index
+                # (which should be prev_ver ... restore asset's values to its values
+                prev_ver['_id'] = asset['_id']
+                del prev_ver['_superseded_at_block']
+                mongo_db.tracked_assets.save(prev_ver)
+        mongo_db.tracked_asset_history.remove({'_superseded_at_block': {"$gt": max_block_index}})
+        for asset in pruned_assets: #bring the asset cache back in line with the rolled back assets
+            cache.refresh_asset(mongo_db, asset)
 
         config.CAUGHT_UP = False
+        publish_blockfeed_state(mongo_db, new_epoch=True)
         latest_block = mongo_db.processed_blocks.find_one({"block_index": max_block_index}) or LATEST_BLOCK_INIT
         return latest_block
     
+    def undo_blocks(undo_records):
+        """rolls back the writes for the blocks with the given undo records (which must be newest first). Returns
+        the names of the tracked assets that were rolled back"""
+        pruned_assets = set()
+        removals = {} #key = collection, value = list of _ids of the records to remove
+        for undo_record in undo_records:
+            for op in reversed(undo_record['ops']):
+                if op['op'] == 'remove': #record inserted in the block
+                    removals.setdefault(op['collection'], []).append(op['_id'])
+                elif op['op'] == 'restore_asset': #tracked asset modified in the block
+                    #(only restore if the modification made it into mongo, i.e. if we didn't die partway through writing it)
+                    logging.info("Pruning asset %s (restoring to its state before block %i)" % (op['asset'], undo_record['block_index']))
+                    pruned_assets.add(op['asset'])
+                    mongo_db.tracked_assets.update({'asset': op['asset'], '_at_block': undo_record['block_index']},
+                        {'$set': op['state']})
+                else: #previous last balance change for an (address, asset) pair
+                    assert op['op'] == 'last_balance'
+                    if op['record']:
+                        last_balances[(op['address'], op['asset'])] = op['record']
+                    else:
+                        last_balances.pop((op['address'], op['asset']), None)
+        if 'tracked_assets' in removals:
+            pruned_assets.update([a['asset'] for a in mongo_db.tracked_assets.find(
+                {'_id': {'$in': removals['tracked_assets']}}, {'asset': 1})])
+        for collection, ids in removals.iteritems():
+            mongo_db[collection].remove({'_id': {'$in': ids}})
+        return pruned_assets
+    
+    def flush_batch():
+        """writes out all pending derived data in one go (committing the blocks in the batch), then sends out
+        any events for those blocks to listening clients"""
+        last_block_index = batch.last_block_index
+        flush_start = time.time()
+        batch.flush()
+        stats.add_time('writes', time.time() - flush_start)
+        if last_block_index is not None:
+            config.CURRENT_BLOCK_INDEX = last_block_index
+            #trim undo records we no longer need (i.e. for blocks deeper than any reorg we'd expect to see)
+            mongo_db.block_undo.remove({"block_index": {"$lte": last_block_index - config.BLOCKFEED_UNDO_DEPTH}})
+            #and keep the event log to its window of recent blocks
+            mongo_db.event_log.remove({"block_index": {"$lte": last_block_index - config.EVENT_LOG_BLOCKS}})
+        publish_blockfeed_state(mongo_db)
+        for event, addresses, asset_pair in pending_events:
+            publish_event(event, addresses, asset_pair)
+        cache.add_events([e[0] for e in pending_events]) #(for clients catching up on what they missed)
+        del pending_events[:]
+
+    def publish_event(event, addresses=None, asset_pair=None):
+        """sends an event out to the socket.io message feed servers (in this process, or subscribed from others).
+        Along with each event go the addresses and asset pair it is for (see util.get_event_routing), and the message
+        index of the one published before it, so that subscribers can tell if they missed any"""
+        zmq_publisher_eventfeed.send_json({'event': event, 'addresses': addresses or [], 'asset_pair': asset_pair,
+            'prev_message_index': feed_state['last_published_message_index']})
+        feed_state['last_published_message_index'] = event['_message_index']
+
+    def find_tracked_asset(asset):
+        #(the asset cache is kept current with what is pending in the batch, so no need to flush before reading)
+        return cache.get_asset(mongo_db, asset)
+
+    def load_last_balances():
+        """warms our in-memory index of the last balance change for each (address, asset) pair from mongo"""
+        last_balances.clear()
+        bal_changes = mongo_db.balance_changes.find({}, LAST_BALANCE_FIELDS).sort("block_index", pymongo.ASCENDING)
+        for bal_change in bal_changes: #oldest to newest, so the last one seen for each pair wins
+            last_balances[(bal_change['address'], bal_change['asset'])] = bal_change
+        logging.info("Loaded last balances for %i address/asset pairs" % len(last_balances))
+    
+    def track_issuance(cur_block, msg, msg_data, undo_ops):
+        """updates the tracked asset for an issuance. this is done inline in the message loop (rather than in a
+        worker), as the balance and trade workers depend on the assets they handle being tracked (i.e. for their
+        divisibility) as of the message they are handling"""
+        cur_block_index = cur_block['block_index']
+        tracked_asset = find_tracked_asset(msg_data['asset']) #may be None
+
+        if tracked_asset: #we are modifying an existing asset
+            #keep the state it is leaving behind in its history (to allow for block rollbacks)
+            prev_ver = dict(tracked_asset, _superseded_at_block=cur_block_index)
+            batch.insert('tracked_asset_history', prev_ver)
+            undo_ops.append({'op': 'remove', 'collection': 'tracked_asset_history', '_id': prev_ver['_id']})
+            undo_ops.append({'op': 'restore_asset', 'asset': msg_data['asset'], 'state': tracked_asset})
+
+        #(the asset cache is updated along with each write, so that later lookups see the asset's new state
+        # without waiting for the write to be flushed)
+        if msg_data['locked']: #lock asset
+            assert tracked_asset
+            asset_changes = {
+                '_at_block': cur_block_index,
+                '_at_block_time': cur_block['block_time_obj'], 
+                '_change_type': 'locked',
+                'locked': True,
+            }
+            batch.update('tracked_assets', {'asset': msg_data['asset']}, {"$set": asset_changes}, upsert=False)
+            cache.set_asset(dict(tracked_asset, **asset_changes))
+        elif msg_data['transfer']: #transfer asset
+            assert tracked_asset
+            asset_changes = {
+                '_at_block': cur_block_index,
+                '_at_block_time': cur_block['block_time_obj'], 
+                '_change_type': 'transferred',
+                'owner': msg_data['issuer'],
+            }
+            batch.update('tracked_assets', {'asset': msg_data['asset']}, {"$set": asset_changes}, upsert=False)
+            cache.set_asset(dict(tracked_asset, **asset_changes))
+        elif msg_data['quantity'] == 0: #change description
+            assert tracked_asset
+            asset_changes = {
+                '_at_block': cur_block_index,
+                '_at_block_time': cur_block['block_time_obj'], 
+                '_change_type': 'changed_description',
+                'description': msg_data['description'],
+            }
+            batch.update('tracked_assets', {'asset': msg_data['asset']}, {"$set": asset_changes}, upsert=False)
+            cache.set_asset(dict(tracked_asset, **asset_changes))
+            modify_extended_asset_info(msg_data['asset'], msg_data['description'])
+        else: #issue new asset or issue addition qty of an asset
+            if not tracked_asset: #new issuance
+                tracked_asset = {
+                    '_change_type': 'created',
+                    '_at_block': cur_block_index, #the block ID this asset is current for
+                    '_at_block_time': cur_block['block_time_obj'], 
+                    #^ NOTE: (if there are multiple asset tracked changes updates in a single block for the same
+                    # asset, the last one with _at_block == that block id in the asset's history is the
+                    # final version for that asset at that block
+                    'asset': msg_data['asset'],
+                    'owner': msg_data['issuer'],
+                    'description': msg_data['description'],
+                    'divisible': msg_data['divisible'],
+                    'locked': False,
+                    'total_issued': msg_data['quantity'],
+                    'total_issued_normalized': util.normalize_quantity(msg_data['quantity'], msg_data['divisible']),
+                }
+                batch.insert('tracked_assets', tracked_asset)
+                cache.set_asset(tracked_asset)
+                undo_ops.append({'op': 'remove', 'collection': 'tracked_assets', '_id': tracked_asset['_id']})
+                modify_extended_asset_info(msg_data['asset'], msg_data['description'])
+            else: #issuing additional of existing asset
+                assert tracked_asset
+                asset_changes = {
+                    '_at_block': cur_block_index,
+                    '_at_block_time': cur_block['block_time_obj'], 
+                    '_change_type': 'issued_more',
+                }
+                quantity_normalized = util.normalize_quantity(msg_data['quantity'], msg_data['divisible'])
+                batch.update('tracked_assets',
+                    {'asset': msg_data['asset']},
+                    {"$set": asset_changes,
+                     "$inc": {
+                         'total_issued': msg_data['quantity'],
+                         'total_issued_normalized': quantity_normalized
+                     }}, upsert=False)
+                cache.set_asset(dict(tracked_asset, 
+                    total_issued=tracked_asset['total_issued'] + msg_data['quantity'],
+                    total_issued_normalized=tracked_asset['total_issued_normalized'] + quantity_normalized,
+                    **asset_changes))
+
+    def track_balance_change(cur_block, msg, msg_data, undo_ops):
+        """records the balance change for a credit or debit. Returns the balance_changes record it went into (or
+        None if the credit/debit was ignored)"""
+        cur_block_index = cur_block['block_index']
+        actionName = 'credit' if msg['category'] == 'credits' else 'debit'
+        address = msg_data['address']
+        asset_info = find_tracked_asset(msg_data['asset'])
+        if asset_info is None:
+            logging.warn("Credit/debit of %s where asset ('%s') does not exist. Ignoring..." % (msg_data['quantity'], msg_data['asset']))
+            return None
+        quantity = msg_data['quantity'] if msg['category'] == 'credits' else -msg_data['quantity']
+        quantity_normalized = util.normalize_quantity(quantity, asset_info['divisible'])
+
+        #look up the previous balance to go off of
+        last_bal_change = last_balances.get((address, asset_info['asset']), None)
+
+        if     last_bal_change \
+           and last_bal_change['block_index'] == cur_block_index:
+            #modify this record, as we want at most one entry per block index for each (address, asset) pair
+            last_bal_change['quantity'] += quantity
+            last_bal_change['quantity_normalized'] += quantity_normalized
+            last_bal_change['new_balance'] += quantity
+            last_bal_change['new_balance_normalized'] += quantity_normalized
+            batch.update('balance_changes', {'_id': last_bal_change['_id']}, {"$inc": {
+                'quantity': quantity,
+                'quantity_normalized': quantity_normalized,
+                'new_balance': quantity,
+                'new_balance_normalized': quantity_normalized,
+            }})
+            logging.debug("Procesed %s bal change (UPDATED) from tx %s :: %s" % (actionName, msg['message_index'], last_bal_change))
+            bal_change = last_bal_change
+        else: #new balance change record for this block
+            bal_change = {
+                'address': address, 
+                'asset': asset_info['asset'],
+                'block_index': cur_block_index,
+                'block_time': cur_block['block_time_obj'],
+                'quantity': quantity,
+                'quantity_normalized': quantity_normalized,
+                'new_balance': last_bal_change['new_balance'] + quantity if last_bal_change else quantity,
+                'new_balance_normalized': last_bal_change['new_balance_normalized'] + quantity_normalized if last_bal_change else quantity_normalized,
+            }
+            batch.insert('balance_changes', bal_change)
+            undo_ops.append({'op': 'remove', 'collection': 'balance_changes', '_id': bal_change['_id']})
+            undo_ops.append({'op': 'last_balance', 'address': address, 'asset': asset_info['asset'],
+                'record': dict([(k, last_bal_change[k]) for k in ['_id',] + LAST_BALANCE_FIELDS.keys()]) if last_bal_change else None})
+            last_balances[(address, asset_info['asset'])] = bal_change
+            logging.debug("Procesed %s bal change from tx %s :: %s" % (actionName, msg['message_index'], bal_change))
+        return bal_change
+
+    def handle_balance_change(cur_block, msg, msg_data, undo_ops, event_bal_changes):
+        """(balances worker) if event_bal_changes is specified, the resulting balance change is left in there for
+        building the event for the message (False if the credit/debit was ignored)"""
+        bal_change = track_balance_change(cur_block, msg, msg_data, undo_ops)
+        if event_bal_changes is not None:
+            #(a copy, as the record may be added to by later messages in the block, before the event is built)
+            event_bal_changes[msg['message_index']] = dict(bal_change) if bal_change else False
+
+    def is_trade(msg, msg_data):
+        return (    msg['category'] == 'order_matches'
+                and (   (msg['command'] == 'update' and msg_data['status'] == 'completed') #for a trade with BTC involved, but that is settled (completed)
+                     or ('forward_asset' in msg_data and msg_data['forward_asset'] != 'BTC' and msg_data['backward_asset'] != 'BTC'))) #or for a trade without BTC on either end
+
+    def book_trade(cur_block, msg, msg_data, undo_ops):
+        """(trades worker)"""
+        cur_block_index = cur_block['block_index']
+        if msg['command'] == 'update' and msg_data['status'] == 'completed':
+            #an order is being updated to a completed status (i.e. a BTCpay has completed)
+            tx0_hash, tx1_hash = msg_data['order_match_id'][:64], msg_data['order_match_id'][64:] 
+            #get the order_match this btcpay settles
+            order_match = util.call_jsonrpc_api("get_order_matches",
+                {'filters': [
+                 {'field': 'tx0_hash', 'op': '==', 'value': tx0_hash},
+                 {'field': 'tx1_hash', 'op': '==', 'value': tx1_hash}]
+                }, abort_on_error=True)['result'][0]
+        else:
+            assert msg_data['status'] == 'completed' #should not enter a pending state for non BTC matches
+            order_match = msg_data
+
+        forward_asset_info = find_tracked_asset(order_match['forward_asset'])
+        backward_asset_info = find_tracked_asset(order_match['backward_asset'])
+        base_asset, quote_asset = util.assets_to_asset_pair(order_match['forward_asset'], order_match['backward_asset'])
+
+        #take divisible trade quantities to floating point
+        forward_quantity = util.normalize_quantity(order_match['forward_quantity'], forward_asset_info['divisible'])
+        backward_quantity = util.normalize_quantity(order_match['backward_quantity'], backward_asset_info['divisible'])
+
+        #compose trade
+        trade = {
+            'block_index': cur_block_index,
+            'block_time': cur_block['block_time_obj'],
+            'message_index': msg['message_index'], #secondary temporaral ordering off of when
+            'order_match_id': order_match['tx0_hash'] + order_match['tx1_hash'],
+            'order_match_tx0_index': order_match['tx0_index'],
+            'order_match_tx1_index': order_match['tx1_index'],
+            'order_match_tx0_address': order_match['tx0_address'],
+            'order_match_tx1_address': order_match['tx1_address'],
+            'base_asset': base_asset,
+            'quote_asset': quote_asset,
+            'base_quantity': order_match['forward_quantity'] if order_match['forward_asset'] == base_asset else order_match['backward_quantity'],
+            'quote_quantity': order_match['backward_quantity'] if order_match['forward_asset'] == base_asset else order_match['forward_quantity'],
+            'base_quantity_normalized': forward_quantity if order_match['forward_asset'] == base_asset else backward_quantity,
+            'quote_quantity_normalized': backward_quantity if order_match['forward_asset'] == base_asset else forward_quantity,
+        }
+        trade['unit_price'] = float(
+            ( D(trade['quote_quantity_normalized']) / D(trade['base_quantity_normalized']) ).quantize(
+                D('.00000000'), rounding=decimal.ROUND_HALF_EVEN))
+        trade['unit_price_inverse'] = float(
+            ( D(trade['base_quantity_normalized']) / D(trade['quote_quantity_normalized']) ).quantize(
+                D('.00000000'), rounding=decimal.ROUND_HALF_EVEN))
+
+        batch.insert('trades', trade)
+        undo_ops.append({'op': 'remove', 'collection': 'trades', '_id': trade['_id']})
+        logging.debug("Procesed Trade from tx %s :: %s" % (msg['message_index'], trade))
+
+    def build_events(cur_block_index, event_msgs, event_bal_changes, send_events, log_events, undo_ops):
+        """builds the message feed events for a block's messages in one go (once the workers are done with the block,
+        so that we have the balance changes for its credits and debits). If send_events, they are sent out once the
+        block is flushed (otherwise, only those for invalid messages are). If log_events, they go into the event log"""
+        event_msgs = [(msg, msg_data) for msg, msg_data in event_msgs
+            if event_bal_changes.get(msg['message_index'], None) is not False] #(skipping ignored credits/debits)
+        events = util.create_message_feed_objs_from_cpd_messages(mongo_db, event_msgs, bal_changes=event_bal_changes)
+        routing = util.get_event_routing(events)
+        for event, (addresses, asset_pair) in zip(events, routing):
+            if send_events or event['_status'].lower().startswith('invalid'):
+                pending_events.append((event, addresses, asset_pair))
+            if log_events:
+                log_entry = {
+                    'message_index': event['_message_index'],
+                    'block_index': cur_block_index,
+                    'category': event['_category'],
+                    'addresses': addresses,
+                    'asset_pair': asset_pair,
+                    'event': event,
+                }
+                batch.insert('event_log', log_entry)
+                undo_ops.append({'op': 'remove', 'collection': 'event_log', '_id': log_entry['_id']})
+
+    def join_workers():
+        """waits until the workers are through all the messages handed to them"""
+        for worker in workers:
+            worker.join()
+
     def modify_extended_asset_info(asset, description):
         """adds an asset to asset_extended_info collection if the description is a valid json link. or, if the link
         is not a valid json link, will remove the asset entry from the table if it exists"""
@@ -126,13 +868,27 @@ def process_cpd_blockfeed(mongo_db, zmq_publisher_eventfeed):
     config.INSIGHT_LAST_BLOCK = 0 #simply for printing/alerting purposes
     config.CAUGHT_UP_STARTED_EVENTS = False
     #^ set after we are caught up and start up the recurring events that depend on us being caught up with the blockchain 
+    prefetcher = BlockPrefetcher(config.BLOCKFEED_PREFETCH_WINDOW,
+        config.BLOCKFEED_RANGE_FETCH_SIZE, config.BLOCKFEED_RANGE_FETCH_MIN_BEHIND)
+    stale_check_block_index = None #the last block we refetched due to a suspected stale prefetch
+    new_block_waiter = NewBlockWaiter(zmq_context, config.COUNTERPARTYD_ZMQ_CONNECT)
+    insight_last_checked = 0 #when we last asked insight for its latest block
+    batch = WriteBatch(mongo_db)
+    pending_events = [] #(event, addresses, asset_pair) to send out to listening clients once the writes for their block(s) are flushed
+    feed_state = {'last_published_message_index': None}
+    #the message loop hands each message off to the worker(s) for the derived state it touches, and waits on them
+    # all at the end of the block (undo ops for the block are collected from all of them into one list)
+    balance_worker = BlockfeedWorker('balances', handle_balance_change)
+    trade_worker = BlockfeedWorker('trades', book_trade)
+    workers = [balance_worker, trade_worker]
     
     #grab our stored preferences, and rebuild the database if necessary
     app_config = mongo_db.app_config.find()
     assert app_config.count() in [0, 1]
     if (   app_config.count() == 0
         or config.REPARSE_FORCED
-        or app_config[0]['db_version'] != config.DB_VERSION
+        or (    app_config[0]['db_version'] != config.DB_VERSION
+            and not migrations.can_migrate(app_config[0]['db_version'], config.DB_VERSION))
         or app_config[0]['running_testnet'] != config.TESTNET):
         if app_config.count():
             logging.warn("counterwalletd database version UPDATED (from %i to %i) or testnet setting changed (from %s to %s), or REINIT forced (%s). REBUILDING FROM SCRATCH ..." % (
@@ -143,11 +899,22 @@ def process_cpd_blockfeed(mongo_db, zmq_publisher_eventfeed):
         my_latest_block = LATEST_BLOCK_INIT
     else:
         app_config = app_config[0]
+        #upgrade the existing data in place if our database version was bumped (and we have migrations to get there)
+        if app_config['db_version'] != config.DB_VERSION:
+            migrations.run_migrations(mongo_db, app_config['db_version'], config.DB_VERSION)
+            app_config = mongo_db.app_config.find_one()
+        #make sure our secondary indexes exist (unless we are in the middle of a fast rebuild)
+        if app_config.get('secondary_indexes_built', True):
+            database.init_secondary_indexes(mongo_db)
+            config.SECONDARY_INDEXES_BUILT = True
         #get the last processed block out of mongo
         my_latest_block = mongo_db.processed_blocks.find_one(sort=[("block_index", pymongo.DESCENDING)]) or LATEST_BLOCK_INIT
         #remove any data we have for blocks higher than this (would happen if counterwalletd or mongo died
         # or errored out while processing a block)
         my_latest_block = prune_my_stale_blocks(my_latest_block['block_index'])
+        load_last_balances()
+        cache.load_assets(mongo_db)
+        cache.load_block_times(mongo_db)
 
     #start polling counterpartyd for new blocks    
     while True:
@@ -209,26 +976,49 @@ def process_cpd_blockfeed(mongo_db, zmq_publisher_eventfeed):
         if my_latest_block['block_index'] < last_processed_block['block_index']:
             #need to catch up
             config.CAUGHT_UP = False
+            new_block_waiter.reset()
             
             cur_block_index = my_latest_block['block_index'] + 1
-            #get the blocktime for the next block we have to process 
+            #get the block info (i.e. blocktime) and messages for the next block we have to process (fetching the
+            # blocks after it in the background as we go)
+            fetch_start = time.time()
             try:
-                cur_block = util.call_jsonrpc_api("get_block_info", [cur_block_index,], abort_on_error=True)['result']
+                cur_block, block_data = prefetcher.get(cur_block_index, last_processed_block['block_index'])
             except Exception, e:
                 logging.warn(str(e) + " Waiting 3 seconds before trying again...")
                 time.sleep(3)
                 continue
+            finally:
+                stats.add_time('fetch', time.time() - fetch_start)
             cur_block['block_time_obj'] = datetime.datetime.utcfromtimestamp(cur_block['block_time'])
             cur_block['block_time_str'] = cur_block['block_time_obj'].isoformat()
             
-            #logging.info("Processing block %i ..." % (cur_block_index,))
-            try:
-                block_data = util.call_jsonrpc_api("get_messages", [cur_block_index,], abort_on_error=True)['result']
-            except Exception, e:
-                logging.warn(str(e) + " Waiting 5 seconds before trying again...")
-                time.sleep(5)
+            if (    block_data and config.LAST_MESSAGE_INDEX != -1
+                and block_data[0]['message_index'] != config.LAST_MESSAGE_INDEX + 1
+                and stale_check_block_index != cur_block_index):
+                #this block's data may have been prefetched before counterpartyd reorganized. throw away the prefetch
+                # window and fetch the block again (only once -- if it still doesn't line up, we go on as before)
+                logging.warn("Message index mismatch at start of block %i (expected %s, got %s). Refetching block..." % (
+                    cur_block_index, config.LAST_MESSAGE_INDEX + 1, block_data[0]['message_index']))
+                prefetcher.discard()
+                stale_check_block_index = cur_block_index
                 continue
             
+            #logging.info("Processing block %i ..." % (cur_block_index,))
+            undo_ops = [] #how to roll back each change we make for this block, in the order the changes are made
+            event_msgs = [] #(msg, msg_data) for the messages in this block to send out to listening clients (and/or log)
+            event_bal_changes = {} #key = message_index, value = balance change resulting from the credit/debit
+            #if we're catching up beyond 10 blocks out, make sure not to send out any socket.io events, as to not flood
+            # on a resync (as we may give a 525 to kick the logged in clients out, but we can't guarantee that the
+            # socket.io connection will always be severed as well??)
+            send_events = last_processed_block['block_index'] - my_latest_block['block_index'] < 10 #>= max likely reorg size we'd ever see
+            log_events = last_processed_block['block_index'] - cur_block_index < config.EVENT_LOG_BLOCKS
+            #our buffer of recent events can only serve up events for spans of messages we published every event for
+            if send_events and config.LAST_MESSAGE_INDEX != -1:
+                cache.start_events(config.LAST_MESSAGE_INDEX)
+            elif not send_events:
+                cache.clear_events()
+            reorged = False
             #parse out response (list of txns, ordered as they appeared in the block)
             for msg in block_data:
                 msg_data = json.loads(msg['bindings'])
@@ -243,19 +1033,26 @@ def process_cpd_blockfeed(mongo_db, zmq_publisher_eventfeed):
                     logging.warn("BUG: IGNORED old RAW message %s: %s ..." % (msg['message_index'], msg))
                     continue
                     
-                logging.info("Received message %s: %s ..." % (msg['message_index'], msg))
+                logging.debug("Received message %s: %s ..." % (msg['message_index'], msg))
                 
                 #don't process invalid messages, but do forward them along to clients
                 status = msg_data.get('status', 'valid').lower()
                 if status.startswith('invalid'):
-                    event = util.create_message_feed_obj_from_cpd_message(mongo_db, msg, msg_data=msg_data)
-                    zmq_publisher_eventfeed.send_json(event)
+                    event_msgs.append((msg, msg_data))
                     config.LAST_MESSAGE_INDEX = msg['message_index']
                     continue
                 
                 #HANDLE REORGS
                 if msg['command'] == 'reorg':
                     logging.warn("Blockchain reorginization at block %s" % msg_data['block_index'])
+                    #(get the events for this block's messages so far out ahead of the reorg's)
+                    join_workers()
+                    build_events(cur_block_index, event_msgs, event_bal_changes, send_events, log_events, undo_ops)
+                    del event_msgs[:]
+                    #this block's writes so far get flushed by the prune, so record how to roll them back too (or
+                    # undoing the blocks before it could go wrong, e.g. for an asset modified both there and here)
+                    if cur_block_index > msg_data['block_index'] - 1:
+                        batch.insert(batch.UNDO_COLLECTION, {'block_index': cur_block_index, 'ops': undo_ops})
                     #prune back to and including the specified message_index
                     my_latest_block = prune_my_stale_blocks(msg_data['block_index'] - 1)
                     config.CURRENT_BLOCK_INDEX = msg_data['block_index'] - 1
@@ -267,205 +1064,69 @@ def process_cpd_blockfeed(mongo_db, zmq_publisher_eventfeed):
                     #send out the message to listening clients
                     msg_data['_last_message_index'] = config.LAST_MESSAGE_INDEX 
                     event = util.create_message_feed_obj_from_cpd_message(mongo_db, msg, msg_data=msg_data)
-                    zmq_publisher_eventfeed.send_json(event)
+                    publish_event(event)
+                    reorged = True
                     break #break out of inner loop
                 
                 #track assets
                 if msg['category'] == 'issuances':
-                    tracked_asset = mongo_db.tracked_assets.find_one(
-                        {'asset': msg_data['asset']}, {'_id': 0, '_history': 0})
-                    #^ pulls the tracked asset without the _id and history fields. This may be None
-                    
-                    if msg_data['locked']: #lock asset
-                        assert tracked_asset
-                        mongo_db.tracked_assets.update(
-                            {'asset': msg_data['asset']},
-                            {"$set": {
-                                '_at_block': cur_block_index,
-                                '_at_block_time': cur_block['block_time_obj'], 
-                                '_change_type': 'locked',
-                                'locked': True,
-                             },
-                             "$push": {'_history': tracked_asset } }, upsert=False)
-                    elif msg_data['transfer']: #transfer asset
-                        assert tracked_asset
-                        mongo_db.tracked_assets.update(
-                            {'asset': msg_data['asset']},
-                            {"$set": {
-                                '_at_block': cur_block_index,
-                                '_at_block_time': cur_block['block_time_obj'], 
-                                '_change_type': 'transferred',
-                                'owner': msg_data['issuer'],
-                             },
-                             "$push": {'_history': tracked_asset } }, upsert=False)
-                    elif msg_data['quantity'] == 0: #change description
-                        assert tracked_asset
-                        mongo_db.tracked_assets.update(
-                            {'asset': msg_data['asset']},
-                            {"$set": {
-                                '_at_block': cur_block_index,
-                                '_at_block_time': cur_block['block_time_obj'], 
-                                '_change_type': 'changed_description',
-                                'description': msg_data['description'],
-                             },
-                             "$push": {'_history': tracked_asset } }, upsert=False)
-                        modify_extended_asset_info(msg_data['asset'], msg_data['description'])
-                    else: #issue new asset or issue addition qty of an asset
-                        if not tracked_asset: #new issuance
-                            tracked_asset = {
-                                '_change_type': 'created',
-                                '_at_block': cur_block_index, #the block ID this asset is current for
-                                '_at_block_time': cur_block['block_time_obj'], 
-                                #^ NOTE: (if there are multiple asset tracked changes updates in a single block for the same
-                                # asset, the last one with _at_block == that block id in the history array is the
-                                # final version for that asset at that block
-                                'asset': msg_data['asset'],
-                                'owner': msg_data['issuer'],
-                                'description': msg_data['description'],
-                                'divisible': msg_data['divisible'],
-                                'locked': False,
-                                'total_issued': msg_data['quantity'],
-                                'total_issued_normalized': util.normalize_quantity(msg_data['quantity'], msg_data['divisible']),
-                                '_history': [] #to allow for block rollbacks
-                            }
-                            mongo_db.tracked_assets.insert(tracked_asset)
-                            modify_extended_asset_info(msg_data['asset'], msg_data['description'])
-                        else: #issuing additional of existing asset
-                            assert tracked_asset
-                            mongo_db.tracked_assets.update(
-                                {'asset': msg_data['asset']},
-                                {"$set": {
-                                    '_at_block': cur_block_index,
-                                    '_at_block_time': cur_block['block_time_obj'], 
-                                    '_change_type': 'issued_more',
-                                 },
-                                 "$inc": {
-                                     'total_issued': msg_data['quantity'],
-                                     'total_issued_normalized': util.normalize_quantity(msg_data['quantity'], msg_data['divisible'])
-                                 },
-                                 "$push": {'_history': tracked_asset} }, upsert=False)
+                    msg_start = time.time()
+                    track_issuance(cur_block, msg, msg_data, undo_ops)
+                    stats.add_time('issuances', time.time() - msg_start)
                 
-                #track balance changes for each address
-                bal_change = None
+                #track balance changes for each address, and book trades (in the background)
                 if msg['category'] in ['credits', 'debits',]:
-                    actionName = 'credit' if msg['category'] == 'credits' else 'debit'
-                    address = msg_data['address']
-                    asset_info = mongo_db.tracked_assets.find_one({ 'asset': msg_data['asset'] })
-                    if asset_info is None:
-                        logging.warn("Credit/debit of %s where asset ('%s') does not exist. Ignoring..." % (msg_data['quantity'], msg_data['asset']))
-                        continue
-                    quantity = msg_data['quantity'] if msg['category'] == 'credits' else -msg_data['quantity']
-                    quantity_normalized = util.normalize_quantity(quantity, asset_info['divisible'])
-
-                    #look up the previous balance to go off of
-                    last_bal_change = mongo_db.balance_changes.find_one({
-                        'address': address,
-                        'asset': asset_info['asset']
-                    }, sort=[("block_time", pymongo.DESCENDING)])
-                    
-                    if     last_bal_change \
-                       and last_bal_change['block_index'] == cur_block_index:
-                        #modify this record, as we want at most one entry per block index for each (address, asset) pair
-                        last_bal_change['quantity'] += quantity
-                        last_bal_change['quantity_normalized'] += quantity_normalized
-                        last_bal_change['new_balance'] += quantity
-                        last_bal_change['new_balance_normalized'] += quantity_normalized
-                        mongo_db.balance_changes.save(last_bal_change)
-                        logging.info("Procesed %s bal change (UPDATED) from tx %s :: %s" % (actionName, msg['message_index'], last_bal_change))
-                        bal_change = last_bal_change
-                    else: #new balance change record for this block
-                        bal_change = {
-                            'address': address, 
-                            'asset': asset_info['asset'],
-                            'block_index': cur_block_index,
-                            'block_time': cur_block['block_time_obj'],
-                            'quantity': quantity,
-                            'quantity_normalized': quantity_normalized,
-                            'new_balance': last_bal_change['new_balance'] + quantity if last_bal_change else quantity,
-                            'new_balance_normalized': last_bal_change['new_balance_normalized'] + quantity_normalized if last_bal_change else quantity_normalized,
-                        }
-                        mongo_db.balance_changes.insert(bal_change)
-                        logging.info("Procesed %s bal change from tx %s :: %s" % (actionName, msg['message_index'], bal_change))
+                    balance_worker.put(cur_block, msg, msg_data, undo_ops,
+                        event_bal_changes if send_events or log_events else None)
+                if is_trade(msg, msg_data):
+                    trade_worker.put(cur_block, msg, msg_data, undo_ops)
                 
-                #book trades
-                if (    msg['category'] == 'order_matches'
-                    and (   (msg['command'] == 'update' and msg_data['status'] == 'completed') #for a trade with BTC involved, but that is settled (completed)
-                         or ('forward_asset' in msg_data and msg_data['forward_asset'] != 'BTC' and msg_data['backward_asset'] != 'BTC'))): #or for a trade without BTC on either end
-
-                    if msg['command'] == 'update' and msg_data['status'] == 'completed':
-                        #an order is being updated to a completed status (i.e. a BTCpay has completed)
-                        tx0_hash, tx1_hash = msg_data['order_match_id'][:64], msg_data['order_match_id'][64:] 
-                        #get the order_match this btcpay settles
-                        order_match = util.call_jsonrpc_api("get_order_matches",
-                            {'filters': [
-                             {'field': 'tx0_hash', 'op': '==', 'value': tx0_hash},
-                             {'field': 'tx1_hash', 'op': '==', 'value': tx1_hash}]
-                            }, abort_on_error=True)['result'][0]
-                    else:
-                        assert msg_data['status'] == 'completed' #should not enter a pending state for non BTC matches
-                        order_match = msg_data
-
-                    forward_asset_info = mongo_db.tracked_assets.find_one({'asset': order_match['forward_asset']})
-                    backward_asset_info = mongo_db.tracked_assets.find_one({'asset': order_match['backward_asset']})
-                    base_asset, quote_asset = util.assets_to_asset_pair(order_match['forward_asset'], order_match['backward_asset'])
-
-                    #take divisible trade quantities to floating point
-                    forward_quantity = util.normalize_quantity(order_match['forward_quantity'], forward_asset_info['divisible'])
-                    backward_quantity = util.normalize_quantity(order_match['backward_quantity'], backward_asset_info['divisible'])
-                    
-                    #compose trade
-                    trade = {
-                        'block_index': cur_block_index,
-                        'block_time': cur_block['block_time_obj'],
-                        'message_index': msg['message_index'], #secondary temporaral ordering off of when
-                        'order_match_id': order_match['tx0_hash'] + order_match['tx1_hash'],
-                        'order_match_tx0_index': order_match['tx0_index'],
-                        'order_match_tx1_index': order_match['tx1_index'],
-                        'order_match_tx0_address': order_match['tx0_address'],
-                        'order_match_tx1_address': order_match['tx1_address'],
-                        'base_asset': base_asset,
-                        'quote_asset': quote_asset,
-                        'base_quantity': order_match['forward_quantity'] if order_match['forward_asset'] == base_asset else order_match['backward_quantity'],
-                        'quote_quantity': order_match['backward_quantity'] if order_match['forward_asset'] == base_asset else order_match['forward_quantity'],
-                        'base_quantity_normalized': forward_quantity if order_match['forward_asset'] == base_asset else backward_quantity,
-                        'quote_quantity_normalized': backward_quantity if order_match['forward_asset'] == base_asset else forward_quantity,
-                    }
-                    trade['unit_price'] = float(
-                        ( D(trade['quote_quantity_normalized']) / D(trade['base_quantity_normalized']) ).quantize(
-                            D('.00000000'), rounding=decimal.ROUND_HALF_EVEN))
-                    trade['unit_price_inverse'] = float(
-                        ( D(trade['base_quantity_normalized']) / D(trade['quote_quantity_normalized']) ).quantize(
-                            D('.00000000'), rounding=decimal.ROUND_HALF_EVEN))
-
-                    mongo_db.trades.insert(trade)
-                    logging.info("Procesed Trade from tx %s :: %s" % (msg['message_index'], trade))
-                    
-                #if we're catching up beyond 10 blocks out, make sure not to send out any socket.io events, as to not flood
-                # on a resync (as we may give a 525 to kick the logged in clients out, but we can't guarantee that the
-                # socket.io connection will always be severed as well??)
-                if last_processed_block['block_index'] - my_latest_block['block_index'] < 10: #>= max likely reorg size we'd ever see
-                    #send out the message to listening clients
-                    event = util.create_message_feed_obj_from_cpd_message(mongo_db, msg, msg_data=msg_data)
-                    zmq_publisher_eventfeed.send_json(event)
+                if send_events or log_events:
+                    #send out the message to listening clients (once this block's writes are flushed), and/or log it
+                    event_msgs.append((msg, msg_data))
 
                 #this is the last processed message index
                 config.LAST_MESSAGE_INDEX = msg['message_index']
             
+            if reorged:
+                #don't commit this block: resume from the block we pruned back to (its writes so far were flushed
+                # and pruned along with the rolled back blocks)
+                continue
+            
+            #wait for the workers to finish up with this block before committing it
+            join_workers()
+            if event_msgs:
+                event_start = time.time()
+                build_events(cur_block_index, event_msgs, event_bal_changes, send_events, log_events, undo_ops)
+                stats.add_time('events', time.time() - event_start)
+            
             #block successfully processed, track this in our DB
             new_block = {
                 'block_index': cur_block_index,
                 'block_time': cur_block['block_time_obj'],
                 'block_hash': cur_block['block_hash'],
             }
-            mongo_db.processed_blocks.insert(new_block)
+            #(no need for an undo record if we are so far behind that it would be trimmed straight away)
+            batch.commit_block(new_block,
+                undo_ops if last_processed_block['block_index'] - cur_block_index < config.BLOCKFEED_UNDO_DEPTH else None)
+            cache.append_block_time(cur_block_index, cur_block['block_time_obj'])
             my_latest_block = new_block
-            config.CURRENT_BLOCK_INDEX = cur_block_index
+            #when deep in catch-up, group many blocks into one flush. otherwise, flush every block
+            if (   batch.num_blocks >= config.BLOCKFEED_BULK_FLUSH_BLOCKS
+                or last_processed_block['block_index'] - cur_block_index < config.BLOCKFEED_BULK_FLUSH_BLOCKS):
+                flush_batch()
+            stats.end_block(cur_block_index, last_processed_block['block_index'], len(block_data))
             #get the current insight block
-            if config.INSIGHT_LAST_BLOCK == 0 or config.INSIGHT_LAST_BLOCK - config.CURRENT_BLOCK_INDEX < 10:
+            if (    (config.INSIGHT_LAST_BLOCK == 0 or config.INSIGHT_LAST_BLOCK - cur_block_index < 10)
+                and time.time() - insight_last_checked >= INSIGHT_CHECK_INTERVAL):
                 #update as CURRENT_BLOCK_INDEX catches up with INSIGHT_LAST_BLOCK and/or surpasses it (i.e. if insight gets behind for some reason)
+                #(at most every INSIGHT_CHECK_INTERVAL seconds, as it only moves on with new blocks)
                 block_height_response = util.call_insight_api('/api/status?q=getInfo', abort_on_error=False)
                 config.INSIGHT_LAST_BLOCK = block_height_response['info']['blocks'] if block_height_response else 0
-            logging.info("Block: %i (message_index height=%s) (insight latest block=%s)" % (config.CURRENT_BLOCK_INDEX,
+                insight_last_checked = time.time()
+            #(while catching up, the periodic blockfeed stats summary takes the place of this)
+            logging.log(logging.INFO if last_processed_block['block_index'] - cur_block_index < 10 else logging.DEBUG,
+                "Block: %i (message_index height=%s) (insight latest block=%s)" % (cur_block_index,
                 config.LAST_MESSAGE_INDEX if config.LAST_MESSAGE_INDEX != -1 else '???',
                 config.INSIGHT_LAST_BLOCK if config.INSIGHT_LAST_BLOCK else '???'))
         elif my_latest_block['block_index'] > last_processed_block['block_index']:
@@ -486,6 +1147,11 @@ def process_cpd_blockfeed(mongo_db, zmq_publisher_eventfeed):
                 logging.info("Detected blocks caught up on startup. Setting last message idx to %s, current block index to %s ..." % (
                     config.LAST_MESSAGE_INDEX, config.CURRENT_BLOCK_INDEX))
             
+            if not config.SECONDARY_INDEXES_BUILT:
+                #we were doing a fast rebuild, and are now caught up. build the indexes we deferred, in one pass
+                database.build_deferred_indexes(mongo_db)
+                app_config['secondary_indexes_built'] = True
+            
             if config.CAUGHT_UP and not config.CAUGHT_UP_STARTED_EVENTS:
                 #start up recurring events that depend on us being fully caught up with the blockchain to run
                 logging.debug("Starting event timer: compile_extended_asset_info")
@@ -497,4 +1163,7 @@ def process_cpd_blockfeed(mongo_db, zmq_publisher_eventfeed):
                 config.CAUGHT_UP_STARTED_EVENTS = True
                 
             
-            time.sleep(2) #counterwalletd itself is at least caught up, wait a bit to query again for the latest block from cpd
+            #counterwalletd itself is at least caught up, wait for a new block notification (or a bit) to query again
+            # for the latest block from cpd
+            publish_blockfeed_state(mongo_db)
+            new_block_waiter.wait()
@@ -0,0 +1,173 @@
+"""
+cache: in-process caches of derived state that is read far more often than it changes, shared by all modules
+
+The blockfeed keeps these in step with what it writes (and rolls back), so readers never see a cached value that is
+older than what is in mongo. Cached objects are shared between callers: treat them as read-only (copy before
+modifying).
+"""
+import logging
+import bisect
+import collections
+
+import pymongo
+
+from lib import (config,)
+
+#tracked asset current state (i.e. the tracked_assets record, minus its _id), keyed by asset name
+_assets = {}
+
+
+def load_assets(mongo_db):
+    """(re)loads the asset cache with the current state of every tracked asset"""
+    _assets.clear()
+    for asset_info in mongo_db.tracked_assets.find({}, {'_id': 0}):
+        _assets[asset_info['asset']] = asset_info
+    logging.info("Loaded %i tracked assets into the asset cache" % len(_assets))
+
+
+def get_asset(mongo_db, asset):
+    """Returns the current state of the given tracked asset, or None if it is not being tracked (i.e. doesn't exist)"""
+    asset_info = _assets.get(asset, None)
+    if asset_info is None: #not cached yet (or doesn't exist)
+        asset_info = mongo_db.tracked_assets.find_one({'asset': asset}, {'_id': 0})
+        if asset_info is not None:
+            _assets[asset] = asset_info
+    return asset_info
+
+
+def set_asset(asset_info):
+    """updates the cached state of a tracked asset (called by the blockfeed as it applies changes to the asset)"""
+    asset_info = dict(asset_info)
+    asset_info.pop('_id', None)
+    _assets[asset_info['asset']] = asset_info
+
+
+def remove_asset(asset):
+    _assets.pop(asset, None)
+
+
+def refresh_asset(mongo_db, asset):
+    """rereads the state of a tracked asset from mongo (e.g. after it was rolled back)"""
+    remove_asset(asset)
+    get_asset(mongo_db, asset)
+
+
+def clear_assets():
+    _assets.clear()
+
+
+#block times (as datetime objects) of the blocks we have processed, in block_index order, starting at
+# _block_times_start (processed blocks are contiguous, so this is a dense table)
+_block_times = []
+_block_times_max = [] #running maximum of _block_times (block times aren't strictly increasing), for searching by date
+_block_times_start = None
+
+
+def load_block_times(mongo_db):
+    """(re)loads the block time table from processed_blocks"""
+    clear_block_times()
+    for block in mongo_db.processed_blocks.find({}, {'_id': 0, 'block_index': 1, 'block_time': 1}).sort(
+      "block_index", pymongo.ASCENDING):
+        append_block_time(block['block_index'], block['block_time'])
+    logging.info("Loaded block times for %i blocks" % len(_block_times))
+
+
+def append_block_time(block_index, block_time):
+    """adds the time of the next processed block to the block time table"""
+    global _block_times_start
+    if _block_times_start is None:
+        _block_times_start = block_index
+    assert block_index == _block_times_start + len(_block_times)
+    _block_times.append(block_time)
+    _block_times_max.append(max(block_time, _block_times_max[-1]) if _block_times_max else block_time)
+
+
+def truncate_block_times(max_block_index):
+    """drops the times of blocks after max_block_index from the block time table (e.g. after a reorg)"""
+    if _block_times_start is None:
+        return
+    num_blocks = max(max_block_index - _block_times_start + 1, 0)
+    del _block_times[num_blocks:]
+    del _block_times_max[num_blocks:]
+
+
+def clear_block_times():
+    global _block_times_start
+    del _block_times[:]
+    del _block_times_max[:]
+    _block_times_start = None
+
+
+def get_block_time(block_index):
+    """Returns the block time of the given block, or None if it is not in the block time table"""
+    if _block_times_start is None or not _block_times_start <= block_index < _block_times_start + len(_block_times):
+        return None
+    return _block_times[block_index - _block_times_start]
+
+
+def get_last_block_time_index():
+    """Returns the index of the last block in the block time table (None if it is empty)"""
+    if _block_times_start is None or not _block_times:
+        return None
+    return _block_times_start + len(_block_times) - 1
+
+
+def get_block_indexes_for_dates(start_dt=None, end_dt=None):
+    """Returns a 2 tuple (start_block_index, end_block_index) of the last block at or before start_dt, and the first
+    block at or after end_dt (or the last block, if there is none), as found in the block time table. Either is None
+    if its date is not given, or if the block time table is empty"""
+    if not _block_times:
+        return (None, None)
+    start_block_index = end_block_index = None
+    if start_dt is not None:
+        i = bisect.bisect_right(_block_times_max, start_dt) - 1
+        start_block_index = _block_times_start + i if i >= 0 else None
+    if end_dt is not None:
+        i = min(bisect.bisect_left(_block_times_max, end_dt), len(_block_times_max) - 1)
+        end_block_index = _block_times_start + i
+    return (start_block_index, end_block_index)
+
+
+#the most recently published message feed events, in message_index order, for clients catching up on what they missed
+# (e.g. after a reconnect). The buffer holds every event published for the messages after _events_covered_from
+# (None if it isn't covering any span of messages, e.g. while the blockfeed is catching up and not publishing)
+_events = collections.deque()
+_events_covered_from = None
+
+
+def start_events(message_index):
+    """starts buffering published events for the messages after message_index (if we aren't already)"""
+    global _events_covered_from
+    if _events_covered_from is None and config.MESSAGEFEED_BUFFER_SIZE:
+        _events_covered_from = message_index
+
+
+def add_events(events):
+    """adds the given events (just published, in message_index order) to the buffer, if it is covering their span"""
+    global _events_covered_from
+    if _events_covered_from is None:
+        return
+    _events.extend(events)
+    while len(_events) > config.MESSAGEFEED_BUFFER_SIZE: #we now only have what came after the oldest event dropped
+        _events_covered_from = _events.popleft()['_message_index']
+
+
+def clear_events():
+    """empties the event buffer (e.g. when events stop being published for every message, or after a reorg)"""
+    global _events_covered_from
+    _events.clear()
+    _events_covered_from = None
+
+
+def get_events_since(message_index):
+    """Returns the buffered events for the messages after message_index (oldest first), or None if the buffer
+    does not cover all of them"""
+    if _events_covered_from is None or message_index < _events_covered_from:
+        return None
+    events = []
+    for event in reversed(_events): #(newest first, as we are usually asked for the last few)
+        if event['_message_index'] <= message_index:
+            break
+        events.append(event)
+    events.reverse()
+    return events
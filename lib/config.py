@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
 VERSION = 0.1
 
-DB_VERSION = 21 #a db version increment will cause counterwalletd to rebuild its database off of counterpartyd 
+DB_VERSION = 22 #a db version increment will cause counterwalletd to rebuild its database off of counterpartyd, unless migrations.py has in-place steps to get there
 
 CAUGHT_UP = False #atomic state variable, set to True when counterpartyd AND counterwalletd are caught up
 
+SECONDARY_INDEXES_BUILT = False #set to True once the secondary indexes on the derived collections exist (see database.py)
+
+ALL_ROLES = ['feed', 'api', 'sio', 'chat'] #the parts of counterwalletd that can be run in separate processes (see --role)
+
 UNIT = 100000000
 
 SUBDIR_ASSET_IMAGES = "asset_img" #goes under the data dir and stores retrieved asset images
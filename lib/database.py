@@ -0,0 +1,134 @@
+"""
+database: index management for counterwalletd's mongo collections
+"""
+import logging
+import time
+
+import pymongo
+
+from lib import (config,)
+
+
+def init_base_indexes(mongo_db):
+    """Creates the indexes on the collections that are purged as a result of a reparse that the blockfeed itself
+    needs for correctness (unique constraints, and the lookups it does while processing and pruning blocks). These
+    always exist, even while rebuilding the database"""
+    #processed_blocks
+    mongo_db.processed_blocks.ensure_index('block_index', unique=True)
+    #block_undo
+    mongo_db.block_undo.ensure_index('block_index', unique=True)
+    #tracked_assets
+    mongo_db.tracked_assets.ensure_index('asset', unique=True)
+    mongo_db.tracked_assets.ensure_index('_at_block') #for tracked asset pruning
+    #tracked_asset_history
+    mongo_db.tracked_asset_history.ensure_index([
+        ("asset", pymongo.ASCENDING),
+        ("_at_block", pymongo.ASCENDING)
+    ])
+    mongo_db.tracked_asset_history.ensure_index('_superseded_at_block') #for tracked asset pruning
+    #trades
+    mongo_db.trades.ensure_index([ #events.py and elsewhere (for singlular block_index index access)
+        ("block_index", pymongo.ASCENDING),
+        ("base_asset", pymongo.ASCENDING),
+        ("quote_asset", pymongo.ASCENDING)
+    ])
+    #balance_changes
+    mongo_db.balance_changes.ensure_index('block_index')
+    #asset_market_info
+    mongo_db.asset_market_info.ensure_index('asset', unique=True)
+    #asset_marketcap_history
+    mongo_db.asset_marketcap_history.ensure_index('block_index')
+    #btc_open_orders
+    mongo_db.btc_open_orders.ensure_index('order_tx_hash', unique=True)
+    #asset_extended_info
+    mongo_db.asset_extended_info.ensure_index('asset', unique=True)
+    #event_log
+    mongo_db.event_log.ensure_index('block_index') #for pruning and trimming
+    mongo_db.event_log.ensure_index('message_index') #for filling gaps in the message feed (and catching clients up)
+
+
+def init_secondary_indexes(mongo_db):
+    """Creates the indexes on the collections that are purged as a result of a reparse that only serve API and
+    event queries. When doing a fast rebuild, these are built in one pass once the blockfeed has caught up, instead
+    of being maintained for every insert along the way"""
+    #tracked_assets
+    mongo_db.tracked_assets.ensure_index([
+        ("owner", pymongo.ASCENDING),
+        ("asset", pymongo.ASCENDING),
+    ])
+    #event_log
+    mongo_db.event_log.ensure_index([ #events for given addresses since a given message
+        ("addresses", pymongo.ASCENDING),
+        ("message_index", pymongo.ASCENDING),
+    ])
+    #trades
+    mongo_db.trades.ensure_index([
+        ("base_asset", pymongo.ASCENDING),
+        ("quote_asset", pymongo.ASCENDING),
+        ("block_time", pymongo.DESCENDING)
+    ])
+    #balance_changes
+    mongo_db.balance_changes.ensure_index([
+        ("address", pymongo.ASCENDING),
+        ("asset", pymongo.ASCENDING),
+        ("block_time", pymongo.ASCENDING)
+    ])
+    #asset_marketcap_history
+    mongo_db.asset_marketcap_history.ensure_index([ #events.py
+        ("market_cap_as", pymongo.ASCENDING),
+        ("asset", pymongo.ASCENDING),
+        ("block_index", pymongo.DESCENDING)
+    ])
+    mongo_db.asset_marketcap_history.ensure_index([ #api.py
+        ("market_cap_as", pymongo.ASCENDING),
+        ("block_time", pymongo.DESCENDING)
+    ])
+    #btc_open_orders
+    mongo_db.btc_open_orders.ensure_index('when_created')
+
+
+def init_nonpurged_indexes(mongo_db):
+    """Creates the indexes on the collections that are *not* purged as a result of a reparse"""
+    #preferences
+    mongo_db.preferences.ensure_index('wallet_id', unique=True)
+    mongo_db.preferences.ensure_index('last_touched')
+    #chat_handles
+    mongo_db.chat_handles.ensure_index('wallet_id', unique=True)
+    mongo_db.chat_handles.ensure_index('handle', unique=True)
+    backfill_chat_handles_lower(mongo_db)
+    mongo_db.chat_handles.ensure_index('handle_lower', unique=True, sparse=True) #for case insensitive handle lookups
+    #chat_history
+    mongo_db.chat_history.ensure_index('when')
+    mongo_db.chat_history.ensure_index([
+        ("handle", pymongo.ASCENDING),
+        ("when", pymongo.DESCENDING),
+    ])
+
+
+def backfill_chat_handles_lower(mongo_db):
+    """sets handle_lower (the lower-cased handle, which handles are looked up by) on the chat_handles records from
+    before it existed. Handles that only differ by case from one already backfilled are left without it (and so
+    can't be looked up) until renamed, as they would break the unique index"""
+    handles_lower = set([p['handle_lower'] for p in mongo_db.chat_handles.find(
+        {'handle_lower': {'$exists': True}}, {'handle_lower': 1})])
+    num_backfilled = 0
+    for p in mongo_db.chat_handles.find({'handle_lower': {'$exists': False}}, {'handle': 1}).sort('_id', pymongo.ASCENDING):
+        handle_lower = p['handle'].lower()
+        if handle_lower in handles_lower:
+            logging.warn("Chat handle '%s' clashes with another (case insensitively): not backfilling its handle_lower" % p['handle'])
+            continue
+        mongo_db.chat_handles.update({'_id': p['_id']}, {'$set': {'handle_lower': handle_lower}})
+        handles_lower.add(handle_lower)
+        num_backfilled += 1
+    if num_backfilled:
+        logging.info("Backfilled handle_lower for %i chat handles" % num_backfilled)
+
+
+def build_deferred_indexes(mongo_db):
+    """Builds the secondary indexes that were deferred during a fast rebuild, and marks them as built"""
+    logging.warn("Building deferred secondary indexes (this may take a while)...")
+    start_time = time.time()
+    init_secondary_indexes(mongo_db)
+    mongo_db.app_config.update({}, {'$set': {'secondary_indexes_built': True}})
+    config.SECONDARY_INDEXES_BUILT = True
+    logging.warn("Built deferred secondary indexes in %.1f seconds" % (time.time() - start_time))
@@ -14,7 +14,7 @@ import gevent
 from PIL import Image
 import lxml.html
 
-from lib import (config, util)
+from lib import (config, util, cache)
 
 D = decimal.Decimal
 COMPILE_ASSET_MARKET_INFO_PERIOD = 30 * 60 #in seconds (this is every 30 minutes currently)
@@ -143,17 +143,13 @@ def compile_asset_market_info(mongo_db):
         return mps_xcp_btc, xcp_btc_price, btc_xcp_price
     
     def get_asset_info(asset, at_dt=None):
-        asset_info = mongo_db.tracked_assets.find_one({'asset': asset})
+        asset_info = copy.copy(cache.get_asset(mongo_db, asset)) #(copied, as we may modify it below)
         
         if asset not in ('XCP', 'BTC') and at_dt and asset_info['_at_block_time'] > at_dt:
             #get the asset info at or before the given at_dt datetime
-            for e in reversed(asset_info['_history']): #newest to oldest
-                if e['_at_block_time'] <= at_dt:
-                    asset_info = e
-                    break
-            else: #asset was created AFTER at_dt
-                asset_info = None
-            if asset_info is None: return None
+            asset_info = mongo_db.tracked_asset_history.find_one({'asset': asset, '_at_block_time': {"$lte": at_dt}},
+                sort=[("_at_block", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)])
+            if asset_info is None: return None #asset was created AFTER at_dt
             assert asset_info['_at_block_time'] <= at_dt
           
         #modify some of the properties of the returned asset_info for BTC and XCP
@@ -0,0 +1,109 @@
+"""
+migrations: in-place upgrades of the derived collections from one counterwalletd database version to the next
+
+To add a migration, bump config.DB_VERSION and register a step for the new version with the @migration decorator.
+A step transforms the existing data in place (normally through stream_batches, so that it reports its progress and
+can resume if we die partway through). If a step can't be done in place, register it with requires_reparse=True,
+and the database will be rebuilt from scratch instead (as it is for a version bump with no step registered).
+"""
+import logging
+import time
+
+import pymongo
+
+MIGRATIONS = {} #key = the db version the step migrates TO, value = dict with the step function and whether it needs a reparse
+MIGRATION_BATCH_SIZE = 1000 #number of records to transform at a time
+
+
+def migration(to_version, requires_reparse=False):
+    """registers the decorated function as the step migrating the database from version to_version - 1 to to_version.
+    The function is called with the mongo database object and the version being migrated to"""
+    def decorator(func):
+        assert to_version not in MIGRATIONS
+        MIGRATIONS[to_version] = {'func': func, 'requires_reparse': requires_reparse}
+        return func
+    return decorator
+
+
+def can_migrate(from_version, to_version):
+    """Returns True if we can get the database from from_version up to to_version without a full reparse"""
+    if from_version >= to_version:
+        return False
+    for version in xrange(from_version + 1, to_version + 1):
+        if version not in MIGRATIONS or MIGRATIONS[version]['requires_reparse']:
+            return False
+    return True
+
+
+def run_migrations(mongo_db, from_version, to_version):
+    """Runs each migration step from from_version up to to_version, recording the new db version after each one"""
+    assert can_migrate(from_version, to_version)
+    for version in xrange(from_version + 1, to_version + 1):
+        logging.warn("Migrating counterwalletd database from version %i to %i ..." % (version - 1, version))
+        start_time = time.time()
+        MIGRATIONS[version]['func'](mongo_db, version)
+        mongo_db.app_config.update({}, {'$set': {'db_version': version}, '$unset': {'migration_progress': 1}})
+        logging.warn("Migrated counterwalletd database to version %i in %.1f seconds" % (version, time.time() - start_time))
+
+
+def stream_batches(mongo_db, to_version, collection, query=None, fields=None, pass_name=None):
+    """Iterates over the records in a collection matching query, in batches (in _id order), for a migration step to
+    transform in place. Progress is logged, and the position reached is checkpointed in app_config after each batch
+    is processed. If we die partway through, the pass picks up from the last checkpoint the next time the step runs
+    (so processing a batch should be safe to repeat).
+
+    @param pass_name: Identifies this pass over the collection within the step (defaults to the collection name).
+    Needed if a step makes more than one pass over the same collection.
+    """
+    pass_name = pass_name or collection
+    progress = mongo_db.app_config.find_one().get('migration_progress', None) or {}
+    if progress.get('to_version', None) != to_version: #left over from a different step (or none at all)
+        progress = {'to_version': to_version, 'last_ids': {}, 'done': {}}
+        mongo_db.app_config.update({}, {'$set': {'migration_progress': progress}})
+    if progress['done'].get(pass_name, False):
+        logging.info("Migration to version %i: pass '%s' already completed. Skipping..." % (to_version, pass_name))
+        return
+
+    query = query or {}
+    assert '_id' not in query
+    last_id = progress['last_ids'].get(pass_name, None)
+    num_total = mongo_db[collection].find(query).count()
+    num_done = mongo_db[collection].find(dict(query, _id={'$lte': last_id})).count() if last_id is not None else 0
+    if num_done:
+        logging.warn("Migration to version %i: resuming pass '%s' at %i/%i records" % (to_version, pass_name, num_done, num_total))
+    last_logged = time.time()
+    while True:
+        batch_query = dict(query, _id={'$gt': last_id}) if last_id is not None else query
+        batch = list(mongo_db[collection].find(batch_query, fields).sort('_id', pymongo.ASCENDING).limit(MIGRATION_BATCH_SIZE))
+        if not batch:
+            break
+        yield batch
+        last_id = batch[-1]['_id']
+        num_done += len(batch)
+        mongo_db.app_config.update({}, {'$set': {'migration_progress.last_ids.%s' % pass_name: last_id}})
+        if time.time() - last_logged >= 10:
+            logging.warn("Migration to version %i: pass '%s' at %i/%i records (%.1f%%)" % (
+                to_version, pass_name, num_done, num_total, (100.0 * num_done / num_total) if num_total else 100.0))
+            last_logged = time.time()
+    mongo_db.app_config.update({}, {'$set': {'migration_progress.done.%s' % pass_name: True}})
+    logging.warn("Migration to version %i: pass '%s' completed (%i records)" % (to_version, pass_name, num_done))
+
+
+@migration(22)
+def split_tracked_asset_history(mongo_db, to_version):
+    """moves the prior versions of each tracked asset out of the _history array in its tracked_assets record, into
+    tracked_asset_history"""
+    for batch in stream_batches(mongo_db, to_version, 'tracked_assets', fields={'asset': 1, '_at_block': 1, '_history': 1}):
+        for asset in batch:
+            if '_history' not in asset:
+                continue
+            versions = asset['_history'] #oldest to newest
+            for i in xrange(len(versions)):
+                versions[i]['_superseded_at_block'] = versions[i + 1]['_at_block'] if i + 1 < len(versions) else asset['_at_block']
+            mongo_db.tracked_asset_history.remove({'asset': asset['asset']}) #in case we died partway through this asset
+            if versions:
+                mongo_db.tracked_asset_history.insert(versions)
+            mongo_db.tracked_assets.update({'_id': asset['_id']}, {'$unset': {'_history': 1}})
+    #undo records from before the split roll back assets via _history, so drop them. a reorg into blocks processed
+    # before the migration falls back to the full prune
+    mongo_db.block_undo.remove()
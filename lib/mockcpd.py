@@ -0,0 +1,314 @@
+"""
+mockcpd: a stand-in for counterpartyd (and insight) for benchmarking the blockfeed without a live counterpartyd
+
+Chains to serve come either from a recording of the responses a real counterpartyd gave the blockfeed (see
+RPCRecorder), or are generated synthetically (see SyntheticChain).
+"""
+import json
+import gzip
+import zlib
+import hashlib
+import random
+import logging
+
+from gevent import pywsgi
+import zmq.green as zmq
+
+RECORDED_METHODS = ('get_running_info', 'get_block_info', 'get_messages', 'get_blocks', 'get_orders', 'get_order_matches', 'get_xcp_supply')
+#^ the counterpartyd API methods the blockfeed uses (which are also the ones MockCounterpartyServer serves)
+RUNNING_INFO_DEFAULTS = {'db_version_major': 0, 'db_version_minor': 0, 'running_testnet': False}
+
+
+class RPCRecorder(object):
+    """Records the responses to the counterpartyd API calls the blockfeed makes to a file (gzip-compressed JSON lines
+    of {"method": ..., "params": ..., "result": ...}), to be replayed with RecordedChain. Install by setting
+    util.rpc_recorder to an instance of this"""
+    FLUSH_EVERY = 100 #records
+
+    def __init__(self, path):
+        self.f = gzip.open(path, 'ab') #(appending starts a new gzip member, which reads back fine)
+        self.num_records = 0
+
+    def __call__(self, method, params, result):
+        if method not in RECORDED_METHODS or 'result' not in result:
+            return
+        self.f.write(json.dumps({'method': method, 'params': params, 'result': result['result']}) + '\n')
+        self.num_records += 1
+        if self.num_records % self.FLUSH_EVERY == 0:
+            self.f.flush(zlib.Z_SYNC_FLUSH) #so that a recording cut short by a kill is still readable
+
+    def close(self):
+        self.f.close()
+
+
+class RecordedChain(object):
+    """A chain replayed from an RPCRecorder recording. Only the blocks for which we have both the block info and
+    the messages are served, and they must be contiguous"""
+    def __init__(self, path):
+        self.blocks = {} #key = block_index, value = block info
+        self.messages = {} #key = block_index, value = list of messages
+        self.orders = {} #key = tx_hash
+        self.order_matches = {} #key = tx0_hash + tx1_hash
+        self.xcp_supply = 0
+        self.running_info = dict(RUNNING_INFO_DEFAULTS)
+        f = gzip.open(path, 'rb')
+        try:
+            for line in f:
+                record = json.loads(line)
+                method, params, result = record['method'], record['params'], record['result']
+                if method == 'get_block_info':
+                    self.blocks[_get_param(params, 'block_index')] = result
+                elif method == 'get_messages':
+                    self.messages[_get_param(params, 'block_index')] = result
+                elif method == 'get_blocks':
+                    for block in result:
+                        self.messages[block['block_index']] = block.pop('_messages')
+                        self.blocks[block['block_index']] = block
+                elif method == 'get_orders':
+                    for order in result:
+                        self.orders[order['tx_hash']] = order
+                elif method == 'get_order_matches':
+                    for order_match in result:
+                        self.order_matches[order_match['tx0_hash'] + order_match['tx1_hash']] = order_match
+                elif method == 'get_xcp_supply':
+                    self.xcp_supply = result
+                else:
+                    assert method == 'get_running_info'
+                    for k in RUNNING_INFO_DEFAULTS.keys():
+                        self.running_info[k] = result.get(k, RUNNING_INFO_DEFAULTS[k])
+        finally:
+            f.close()
+
+        block_indexes = sorted(set(self.blocks.keys()) & set(self.messages.keys()))
+        if not block_indexes:
+            raise Exception("No complete blocks in recording %s" % path)
+        self.first_block_index = block_indexes[0]
+        self.last_block_index = block_indexes[0] + len(block_indexes) - 1
+        if self.last_block_index != block_indexes[-1]:
+            raise Exception("Blocks in recording %s are not contiguous" % path)
+        logging.info("Loaded recording of blocks %i to %i (%i messages)" % (
+            self.first_block_index, self.last_block_index, sum([len(m) for m in self.messages.itervalues()])))
+
+    def get_block_info(self, block_index):
+        return self.blocks[block_index]
+
+    def get_messages(self, block_index):
+        return self.messages[block_index]
+
+    def get_order(self, tx_hash):
+        return self.orders.get(tx_hash, None)
+
+    def get_order_match(self, tx0_hash, tx1_hash):
+        return self.order_matches.get(tx0_hash + tx1_hash, None)
+
+    def get_order_matches_by_tx0(self, tx0_hashes):
+        return [m for m in self.order_matches.itervalues() if m['tx0_hash'] in tx0_hashes]
+
+
+class SyntheticChain(object):
+    """A generated chain, for load testing. The first block issues num_assets assets, and every block after that
+    has the same number of credits (spread randomly over num_addresses addresses and the issued assets) and trades
+    (of the issued assets against XCP). Blocks are generated on demand (deterministically, from the seed), so that
+    large chains don't have to be held in memory"""
+    BLOCK_TIME_FIRST = 1400000000 #unix time of the first block
+    BLOCK_TIME_SPACING = 600 #seconds between blocks
+
+    def __init__(self, num_blocks=10000, num_credits=1000000, num_addresses=100000, num_assets=100, num_trades=10000,
+      first_block_index=300000, seed=0):
+        assert num_blocks >= 2 and num_addresses >= 2 and num_assets >= 1
+        self.first_block_index = first_block_index
+        self.last_block_index = first_block_index + num_blocks - 1
+        self.credits_per_block = num_credits // (num_blocks - 1)
+        self.trades_per_block = num_trades // (num_blocks - 1)
+        self.num_addresses = num_addresses
+        self.assets = [_synthetic_asset_name(i) for i in xrange(num_assets)]
+        self.seed = seed
+        self.xcp_supply = 2600000 * 100000000
+        self.running_info = dict(RUNNING_INFO_DEFAULTS)
+        logging.info("Generating synthetic chain of blocks %i to %i (%i assets, %i credits and %i trades per block)" % (
+            self.first_block_index, self.last_block_index, num_assets, self.credits_per_block, self.trades_per_block))
+
+    def _address(self, n):
+        return '1' + hashlib.sha256('%i:%i' % (self.seed, n)).hexdigest()[:33]
+
+    def _hash(self, *args):
+        return hashlib.sha256(':'.join([str(self.seed)] + [str(a) for a in args])).hexdigest()
+
+    def get_block_info(self, block_index):
+        offset = block_index - self.first_block_index
+        return {
+            'block_index': block_index,
+            'block_hash': self._hash('block', block_index),
+            'block_time': self.BLOCK_TIME_FIRST + (offset * self.BLOCK_TIME_SPACING),
+        }
+
+    def get_messages(self, block_index):
+        offset = block_index - self.first_block_index
+        block_time = self.BLOCK_TIME_FIRST + (offset * self.BLOCK_TIME_SPACING)
+        rand = random.Random('%i:%i' % (self.seed, block_index))
+        if offset == 0:
+            message_index = 0
+            entries = [('issuances', {
+                'asset': asset,
+                'issuer': self._address(i),
+                'quantity': 1000000 * 100000000,
+                'divisible': i % 2 == 0,
+                'transfer': False,
+                'locked': False,
+                'description': 'synthetic asset %i' % i,
+                'status': 'valid',
+            }) for i, asset in enumerate(self.assets)]
+        else:
+            message_index = len(self.assets) + (offset - 1) * (self.credits_per_block + self.trades_per_block)
+            entries = []
+            for i in xrange(self.credits_per_block):
+                entries.append(('credits', {
+                    'address': self._address(rand.randrange(self.num_addresses)),
+                    'asset': rand.choice(self.assets),
+                    'quantity': rand.randint(1, 100000000),
+                    'block_index': block_index,
+                }))
+            for i in xrange(self.trades_per_block):
+                tx0_index, tx1_index = rand.randrange(1000000), rand.randrange(1000000)
+                entries.append(('order_matches', {
+                    'tx0_index': tx0_index,
+                    'tx0_hash': self._hash('tx', block_index, i, 0),
+                    'tx0_address': self._address(rand.randrange(self.num_addresses)),
+                    'tx1_index': tx1_index,
+                    'tx1_hash': self._hash('tx', block_index, i, 1),
+                    'tx1_address': self._address(rand.randrange(self.num_addresses)),
+                    'forward_asset': rand.choice(self.assets),
+                    'forward_quantity': rand.randint(1, 100000000),
+                    'backward_asset': 'XCP',
+                    'backward_quantity': rand.randint(1, 100000000),
+                    'block_index': block_index,
+                    'status': 'completed',
+                }))
+        messages = []
+        for i, (category, bindings) in enumerate(entries):
+            messages.append({
+                'message_index': message_index + i,
+                'block_index': block_index,
+                'command': 'insert',
+                'category': category,
+                'bindings': json.dumps(bindings),
+                'timestamp': block_time,
+            })
+        return messages
+
+    def get_order(self, tx_hash):
+        return None #orders are never updated (the only ones the blockfeed looks up)
+
+    def get_order_match(self, tx0_hash, tx1_hash):
+        return None #no BTC trades (the only ones the blockfeed looks up)
+
+    def get_order_matches_by_tx0(self, tx0_hashes):
+        return []
+
+
+def _synthetic_asset_name(n):
+    name = ''
+    n += 26 ** 4 #asset names are at least 4 letters, and can't start with an A (so start at BAAAA)
+    while n:
+        n, r = divmod(n, 26)
+        name = chr(ord('A') + r) + name
+    return name
+
+
+def _get_param(params, name, position=0):
+    return params[name] if isinstance(params, dict) else params[position]
+
+
+class MockCounterpartyServer(object):
+    """Serves a chain over counterpartyd's JSON-RPC API (the subset of it the blockfeed uses), as well as insight's
+    getInfo status call, from the same HTTP server. The chain is served up to released_block_index, and more
+    blocks can be released as we go, with a new block notification published over ZeroMQ for each"""
+    def __init__(self, chain, host, port, zmq_context=None, zmq_notify_bind=None, released_block_index=None):
+        self.chain = chain
+        self.host = host
+        self.port = port
+        self.released_block_index = released_block_index or chain.last_block_index
+        self._running_info = None #cached for released_block_index
+        self.notify_socket = None
+        if zmq_notify_bind:
+            self.notify_socket = zmq_context.socket(zmq.PUB)
+            self.notify_socket.bind(zmq_notify_bind)
+        self.server = pywsgi.WSGIServer((host, port), self.handle_request, log=None)
+
+    def start(self):
+        self.server.start()
+        logging.info("Mock counterpartyd serving blocks %i to %i on %s:%i" % (
+            self.chain.first_block_index, self.released_block_index, self.host, self.port))
+
+    def stop(self):
+        self.server.stop()
+
+    def release_block(self):
+        """makes the next block of the chain available, and notifies listeners"""
+        assert self.released_block_index < self.chain.last_block_index
+        self.released_block_index += 1
+        if self.notify_socket is not None:
+            self.notify_socket.send_json({'block_index': self.released_block_index})
+
+    def _get_block(self, block_index):
+        if not self.chain.first_block_index <= block_index <= self.released_block_index:
+            raise Exception("No such block: %s" % block_index)
+        return self.chain.get_block_info(block_index), self.chain.get_messages(block_index)
+
+    def call(self, method, params):
+        if method == 'get_running_info':
+            if self._running_info is None or self._running_info['last_block']['block_index'] != self.released_block_index:
+                last_message_index = -1
+                for i in xrange(self.released_block_index, self.chain.first_block_index - 1, -1):
+                    messages = self.chain.get_messages(i)
+                    if messages:
+                        last_message_index = messages[-1]['message_index']
+                        break
+                self._running_info = dict(self.chain.running_info,
+                    db_caught_up=False, #(so that the blockfeed doesn't start up its timers that go out to other services)
+                    last_block=self.chain.get_block_info(self.released_block_index),
+                    last_message_index=last_message_index)
+            return self._running_info
+        elif method == 'get_block_info':
+            return self._get_block(_get_param(params, 'block_index'))[0]
+        elif method == 'get_messages':
+            return self._get_block(_get_param(params, 'block_index'))[1]
+        elif method == 'get_blocks':
+            blocks = []
+            for block_index in _get_param(params, 'block_indexes'):
+                block_info, messages = self._get_block(block_index)
+                blocks.append(dict(block_info, _messages=messages))
+            return blocks
+        elif method == 'get_orders': #(by tx_hash, any of those given)
+            orders = [self.chain.get_order(f['value']) for f in _get_param(params, 'filters') if f['field'] == 'tx_hash']
+            return [order for order in orders if order]
+        elif method == 'get_order_matches' and isinstance(params, dict) and params.get('filterop', 'and') == 'or':
+            #(by tx0_hash, any of those given)
+            return self.chain.get_order_matches_by_tx0(set(
+                [f['value'] for f in _get_param(params, 'filters') if f['field'] == 'tx0_hash']))
+        elif method == 'get_order_matches':
+            filters = dict([(f['field'], f['value']) for f in _get_param(params, 'filters')])
+            order_match = self.chain.get_order_match(filters.get('tx0_hash', None), filters.get('tx1_hash', None))
+            return [order_match] if order_match else []
+        else:
+            assert method == 'get_xcp_supply'
+            return self.chain.xcp_supply
+
+    def handle_request(self, env, start_response):
+        if env['REQUEST_METHOD'] == 'GET' and env['PATH_INFO'] == '/api/status': #insight (only getInfo is used)
+            body = {'info': {'blocks': self.released_block_index}}
+        elif env['REQUEST_METHOD'] == 'POST' and env['PATH_INFO'].rstrip('/') == '/api':
+            request = json.loads(env['wsgi.input'].read())
+            body = {'jsonrpc': '2.0', 'id': request.get('id', 0)}
+            if request['method'] not in RECORDED_METHODS:
+                body['error'] = {'code': -32601, 'message': "Method not found: %s" % request['method']}
+            else:
+                try:
+                    body['result'] = self.call(request['method'], request.get('params', []))
+                except Exception, e:
+                    body['error'] = {'code': -32000, 'message': str(e)}
+        else:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return ["Not found"]
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return [json.dumps(body)]
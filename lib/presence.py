@@ -0,0 +1,146 @@
+"""
+presence: tracks which wallets are online (i.e. have a client connected to a chat server), for the chat /online and
+/msg commands and the order book's online status
+
+Chat servers register the sessions connected to them (on each client ping), and heartbeat their wallets to the
+presence backend, where they expire if not heartbeated again within PRESENCE_TTL (e.g. if the chat server process
+goes away). Wallets with a session connected to this process are known to be online without asking the backend.
+The local backend only knows about this process; the redis backend shares presence between processes (e.g. when
+running the chat and api roles in separate processes).
+"""
+import os
+import socket
+import logging
+import time
+
+import gevent
+
+PRESENCE_TTL = 90 #seconds a heartbeat keeps a wallet online for
+HEARTBEAT_INTERVAL = 30 #seconds between heartbeats for the wallets with sessions connected to this process
+REDIS_KEY_PREFIX = 'presence:'
+
+
+class LocalPresenceBackend(object):
+    """keeps presence in this process only"""
+    def __init__(self):
+        self._expires = {} #key = wallet ID, value = time its presence expires
+
+    def heartbeat(self, wallet_ids, ttl):
+        expires = time.time() + ttl
+        for wallet_id in wallet_ids:
+            self._expires[wallet_id] = expires
+
+    def remove(self, wallet_id):
+        self._expires.pop(wallet_id, None)
+
+    def get_online(self, wallet_ids):
+        now = time.time()
+        online = set()
+        for wallet_id in wallet_ids:
+            expires = self._expires.get(wallet_id, None)
+            if expires is None:
+                continue
+            if expires > now:
+                online.add(wallet_id)
+            else:
+                del self._expires[wallet_id]
+        return online
+
+
+class RedisPresenceBackend(object):
+    """shares presence between processes through redis. Each wallet has a sorted set of the processes it is online
+    with, scored by when that expires, so one process dropping the wallet doesn't take it offline for the others"""
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.process_id = "%s:%i" % (socket.gethostname(), os.getpid())
+
+    def heartbeat(self, wallet_ids, ttl):
+        now = time.time()
+        pipe = self.redis_client.pipeline(transaction=False)
+        for wallet_id in wallet_ids:
+            key = REDIS_KEY_PREFIX + wallet_id
+            pipe.zadd(key, now + ttl, self.process_id)
+            pipe.zremrangebyscore(key, '-inf', now) #drop processes that stopped heartbeating
+            pipe.expire(key, int(ttl) + 1)
+        pipe.execute()
+
+    def remove(self, wallet_id):
+        self.redis_client.zrem(REDIS_KEY_PREFIX + wallet_id, self.process_id)
+
+    def get_online(self, wallet_ids):
+        now = time.time()
+        pipe = self.redis_client.pipeline(transaction=False)
+        for wallet_id in wallet_ids:
+            pipe.zcount(REDIS_KEY_PREFIX + wallet_id, now, '+inf')
+        return set([wallet_id for wallet_id, count in zip(wallet_ids, pipe.execute()) if count])
+
+
+_backend = LocalPresenceBackend()
+_sessions = {} #key = wallet ID, value = set of the chat sessions (namespaces) for it connected to this process
+
+
+def init(backend):
+    """sets the presence backend to use, and starts heartbeating the wallets with sessions connected to this process"""
+    global _backend
+    _backend = backend
+    gevent.spawn(_heartbeat_sessions)
+
+
+def _heartbeat_sessions():
+    while True:
+        gevent.sleep(HEARTBEAT_INTERVAL)
+        if not _sessions:
+            continue
+        try:
+            _backend.heartbeat(_sessions.keys(), PRESENCE_TTL)
+        except Exception, e:
+            logging.warn("Could not heartbeat presence for %i wallets: %s" % (len(_sessions), e))
+
+
+def add_session(wallet_id, session):
+    """registers a chat session (namespace) for the wallet as connected to this process"""
+    if wallet_id in _sessions:
+        _sessions[wallet_id].add(session)
+        return
+    _sessions[wallet_id] = set([session])
+    try:
+        _backend.heartbeat([wallet_id], PRESENCE_TTL)
+    except Exception, e:
+        logging.warn("Could not heartbeat presence for wallet %s: %s" % (wallet_id, e))
+
+
+def remove_session(wallet_id, session):
+    """unregisters a chat session for the wallet (e.g. when it disconnects)"""
+    sessions = _sessions.get(wallet_id, None)
+    if sessions is None:
+        return
+    sessions.discard(session)
+    if sessions:
+        return
+    del _sessions[wallet_id]
+    try:
+        _backend.remove(wallet_id)
+    except Exception, e:
+        logging.warn("Could not remove presence for wallet %s: %s" % (wallet_id, e))
+
+
+def get_online(wallet_ids):
+    """Returns the set of the given wallet IDs that are online (with one backend lookup, for those without a session
+    connected to this process)"""
+    online = set()
+    other_wallet_ids = []
+    for wallet_id in set(wallet_ids):
+        if wallet_id in _sessions:
+            online.add(wallet_id)
+        else:
+            other_wallet_ids.append(wallet_id)
+    if other_wallet_ids:
+        try:
+            online.update(_backend.get_online(other_wallet_ids))
+        except Exception, e:
+            logging.warn("Could not look up presence for %i wallets: %s" % (len(other_wallet_ids), e))
+    return online
+
+
+def is_online(wallet_id):
+    return wallet_id in get_online([wallet_id])
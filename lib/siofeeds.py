@@ -6,50 +6,198 @@ import socket
 import collections
 import json
 
+import gevent
 import zmq.green as zmq
 import pymongo
 from socketio import socketio_manage
+from socketio import packet
 from socketio.mixins import BroadcastMixin
 from socketio.namespace import BaseNamespace
 import lxml.html
 
-onlineClients = {} #key = walletID, value = datetime when connected
-#^ tracks "online status" via the chat feed
+from . import (config, util, presence)
 
-class MessagesFeedServerNamespace(BaseNamespace):
-    def __init__(self, *args, **kwargs):
-        super(MessagesFeedServerNamespace, self).__init__(*args, **kwargs)
-        self._running = True
-            
-    def listener(self):
+
+class MessagesFeedDispatcher(object):
+    """Funnels the events the blockfeed publishes out to the subscribed socket.io clients, from a single greenlet.
+    
+    Each client subscribes either to all events, or with filters: a list of addresses, categories and/or asset pairs.
+    A filtered client gets the events that match every kind of filter it gave (and any one of the values given for
+    each). Filtered clients are indexed by the most selective kind of filter they gave, so that each event is only
+    matched against the clients that could want it, not every client.
+    
+    Each event's socket.io packet is encoded once, and the same frame queued up for every client getting it. A client
+    whose queue backs up past CLIENT_QUEUE_MAX frames (i.e. it can't keep up) stops getting events. Once it works
+    its queue back down, it is sent a "resync" event with the last message index it was sent, so that it can fetch
+    what it missed (e.g. via get_messagefeed_messages_since). If it is still backed up after LAGGING_DISCONNECT_AFTER
+    seconds, it is disconnected.
+    
+    Events are received from the blockfeed over ZeroMQ (at config.EVENTFEED_ENDPOINT, which may be in another
+    process). If we find we have missed some (going by the message index of the event published before each one),
+    we fill them in from the event log, or if they aren't in there, have all clients resync."""
+    CLIENT_QUEUE_MAX = 500 #frames
+    CLIENT_QUEUE_RESUME = 50 #frames
+    LAGGING_DISCONNECT_AFTER = 60 #seconds
+    
+    def __init__(self, zmq_context, mongo_db):
+        self.zmq_context = zmq_context
+        self.mongo_db = mongo_db
+        self._all = set() #namespaces of the clients subscribed to everything
+        self._by_address = {} #key = address, value = set of namespaces
+        self._by_asset_pair = {} #key = (base asset, quote asset), value = set of namespaces
+        self._by_category = {} #key = category, value = set of namespaces
+        self._subscriptions = {} #key = namespace, value = (index, index keys, (addresses, categories, asset_pairs))
+        self._last_sent = {} #key = namespace, value = message index of the last event sent to the client
+        self._lagging = {} #key = namespace, value = when the client's queue backed up
+        self.greenlet = gevent.spawn(self._run)
+    
+    def subscribe(self, namespace, filters=None):
+        """(re)subscribes a client. filters is either None/'all', or a dict with any of 'addresses', 'categories' and
+        'asset_pairs' (a list of 2 item lists), each a list of values to match"""
+        if filters and filters != 'all':
+            if not isinstance(filters, dict):
+                raise Exception("filters must be 'all', or an object with addresses, categories and/or asset_pairs")
+            for name in ('addresses', 'categories', 'asset_pairs'):
+                if not isinstance(filters.get(name, None) or [], list):
+                    raise Exception("%s must be a list, even if it just contains one item" % name)
+            if not all([isinstance(p, list) and len(p) == 2 for p in filters.get('asset_pairs', None) or []]):
+                raise Exception("asset_pairs must be a list of 2 item lists")
+            addresses = frozenset(filters.get('addresses', None) or [])
+            categories = frozenset(filters.get('categories', None) or [])
+            asset_pairs = frozenset([util.assets_to_asset_pair(*p) for p in filters.get('asset_pairs', None) or []])
+            if not addresses and not categories and not asset_pairs:
+                raise Exception("No addresses, categories or asset_pairs to filter on")
+        self.unsubscribe(namespace)
+        if not filters or filters == 'all':
+            self._all.add(namespace)
+            self._subscriptions[namespace] = (None, None, None)
+            return
+        if addresses:
+            index, keys = self._by_address, addresses
+        elif asset_pairs:
+            index, keys = self._by_asset_pair, asset_pairs
+        else:
+            index, keys = self._by_category, categories
+        for key in keys:
+            index.setdefault(key, set()).add(namespace)
+        self._subscriptions[namespace] = (index, keys, (addresses, categories, asset_pairs))
+    
+    def unsubscribe(self, namespace):
+        index, keys, filters = self._subscriptions.pop(namespace, (None, None, None))
+        self._all.discard(namespace)
+        self._last_sent.pop(namespace, None)
+        self._lagging.pop(namespace, None)
+        for key in keys or []:
+            index[key].discard(namespace)
+            if not index[key]:
+                del index[key]
+    
+    def get_recipients(self, event, addresses, asset_pair):
+        """Returns the namespaces of the clients the given event should go out to, given the addresses and asset pair
+        it is for (as the blockfeed worked out with util.get_event_routing)"""
+        if event['_category'] == 'reorg': #everybody needs to know about these
+            return set(self._subscriptions.keys())
+        asset_pair = tuple(asset_pair) if asset_pair else None #(comes through as a list)
+        candidates = set()
+        for address in addresses:
+            candidates.update(self._by_address.get(address, []))
+        if asset_pair:
+            candidates.update(self._by_asset_pair.get(asset_pair, []))
+        candidates.update(self._by_category.get(event['_category'], []))
+        recipients = set(self._all)
+        for namespace in candidates:
+            f_addresses, f_categories, f_asset_pairs = self._subscriptions[namespace][2]
+            if (    (not f_addresses or not f_addresses.isdisjoint(addresses))
+                and (not f_categories or event['_category'] in f_categories)
+                and (not f_asset_pairs or asset_pair in f_asset_pairs)):
+                recipients.add(namespace)
+        return recipients
+    
+    def _send(self, namespace, event, frames):
+        client_queue = namespace.socket.client_queue
+        if namespace in self._lagging:
+            if client_queue.qsize() > self.CLIENT_QUEUE_RESUME:
+                if time.time() - self._lagging[namespace] > self.LAGGING_DISCONNECT_AFTER:
+                    logging.info("socket.io: Disconnecting client %s that could not keep up with the message feed" % namespace.socket.sessid)
+                    namespace.socket.disconnect(silent=True)
+                return
+            #it has worked its queue down: have it fetch what it missed (including this event), then carry on
+            del self._lagging[namespace]
+            namespace.emit('resync', {'_last_message_index': self._last_sent.get(namespace, None)})
+            return
+        if client_queue.qsize() >= self.CLIENT_QUEUE_MAX:
+            self._lagging[namespace] = time.time()
+            return
+        if namespace.ns_name not in frames:
+            frames[namespace.ns_name] = packet.encode({
+                'type': 'event',
+                'name': event['_category'],
+                'args': [event,],
+                'endpoint': namespace.ns_name,
+            }, namespace.socket.json_dumps)
+        namespace.socket.put_client_msg(frames[namespace.ns_name])
+        self._last_sent[namespace] = event.get('_message_index', None)
+    
+    def dispatch(self, event, addresses, asset_pair):
+        """sends an event out to the clients that want it"""
+        #logging.info("socket.io: Sending message ID %s -- %s:%s" % (
+        #    event['_message_index'], event['_category'], event['_command']))
+        try:
+            frames = {} #key = namespace endpoint, value = the encoded packet for the event
+            for namespace in self.get_recipients(event, addresses, asset_pair):
+                self._send(namespace, event, frames)
+        except Exception:
+            logging.exception("socket.io: Could not send out message ID %s" % event.get('_message_index', None))
+    
+    def _fill_gap(self, last_message_index, prev_message_index):
+        """called when the events published after last_message_index, up to and including prev_message_index, never
+        reached us"""
+        missed = []
+        if prev_message_index > last_message_index:
+            missed = list(self.mongo_db.event_log.find(
+                {'message_index': {'$gt': last_message_index, '$lte': prev_message_index}},
+                {'_id': 0, 'event': 1, 'addresses': 1, 'asset_pair': 1}).sort("message_index", pymongo.ASCENDING))
+        if missed:
+            logging.warn("socket.io: Missed message feed events after message ID %s. Filling in %i events from the event log" % (
+                last_message_index, len(missed)))
+            for log_entry in missed:
+                self.dispatch(log_entry['event'], log_entry['addresses'], log_entry.get('asset_pair', None))
+        else:
+            logging.warn("socket.io: Missed message feed events after message ID %s. Having all clients resync" % last_message_index)
+            for namespace in self._subscriptions.keys():
+                namespace.emit('resync', {'_last_message_index': last_message_index})
+    
+    def _run(self):
         #subscribe to the zmq queue
-        sock = self.request['zmq_context'].socket(zmq.SUB)
+        sock = self.zmq_context.socket(zmq.SUB)
         sock.setsockopt(zmq.SUBSCRIBE, "")
-        sock.connect('inproc://queue_eventfeed')
-        
-        poller = zmq.Poller()
-        poller.register(sock, zmq.POLLIN)
+        sock.connect(config.EVENTFEED_ENDPOINT)
         
-        #as we receive messages, send them out to the socket.io listener
-        #do this in a way that doesn't block indefinitely, and gracefully falls through if/when a client disconnects
-        while self._running:
-            socks = poller.poll(2500) #wait *up to* 2.5 seconds for events to arrive
-            if socks:
-                event = socks[0][0].recv_json() #only one sock we're polling
-                #logging.info("socket.io: Sending message ID %s -- %s:%s" % (
-                #    event['_message_index'], event['_category'], event['_command']))
-                self.emit(event['_category'], event)
-        #sock.shutdown(socket.SHUT_RDWR)
-        sock.close()
+        #as we receive messages, send them out to the socket.io clients that want them
+        last_message_index = None #of the last event we received
+        while True:
+            envelope = sock.recv_json()
+            event = envelope['event']
+            if (    last_message_index is not None and envelope['prev_message_index'] is not None
+                and envelope['prev_message_index'] != last_message_index):
+                self._fill_gap(last_message_index, envelope['prev_message_index'])
+            self.dispatch(event, envelope['addresses'], envelope['asset_pair'])
+            last_message_index = event['_message_index']
 
-    def on_subscribe(self):
-        if 'listening' not in self.socket.session:
-            self.socket.session['listening'] = True
-            self.spawn(self.listener)
+
+class MessagesFeedServerNamespace(BaseNamespace):
+    def on_subscribe(self, filters=None):
+        """subscribes to the message feed. filters is 'all' (the default) for every event, or an object with any of
+        addresses, categories and asset_pairs to only get the events matching those. Clients should also handle the
+        "resync" event, sent if they fall behind (see MessagesFeedDispatcher)"""
+        try:
+            self.request['dispatcher'].subscribe(self, filters)
+        except Exception, e:
+            return self.error('invalid_args', str(e))
             
     def disconnect(self, silent=False):
         """Triggered when the client disconnects (e.g. client closes their browser)"""
-        self._running = False
+        self.request['dispatcher'].unsubscribe(self)
         return super(MessagesFeedServerNamespace, self).disconnect(silent=silent)
 
         
@@ -57,10 +205,11 @@ class SocketIOMessagesFeedServer(object):
     """
     Funnel messages coming from counterpartyd polls to socket.io clients
     """
-    def __init__(self, zmq_context):
+    def __init__(self, zmq_context, mongo_db):
         # Dummy request object to maintain state between Namespace initialization.
         self.request = {
             'zmq_context': zmq_context,
+            'dispatcher': MessagesFeedDispatcher(zmq_context, mongo_db),
         }        
             
     def __call__(self, environ, start_response):
@@ -70,6 +219,67 @@ class SocketIOMessagesFeedServer(object):
         socketio_manage(environ, {'': MessagesFeedServerNamespace}, self.request)
 
 
+CHAT_HANDLE_CACHE_TTL = 60 #seconds a cached chat handle is trusted for (handles can be changed by other processes)
+_chat_handles = {} #key = lower-cased chat handle, value = dict with the wallet_id, handle (as the user cased it) and when cached
+_chat_handles_by_wallet = {} #key = wallet ID, value = its lower-cased chat handle in _chat_handles
+#^ cache of the handles of the users chatting on this server (or looked up by the chat commands)
+
+
+def set_cached_chat_handle(wallet_id, handle):
+    """records the wallet's current chat handle in the handle cache (or drops the wallet from it, if handle is None)"""
+    handle_lower = _chat_handles_by_wallet.pop(wallet_id, None)
+    if handle_lower is not None and _chat_handles.get(handle_lower, {}).get('wallet_id', None) == wallet_id:
+        del _chat_handles[handle_lower]
+    if handle:
+        stale_entry = _chat_handles.get(handle.lower(), None) #if the handle was someone else's
+        if stale_entry is not None and stale_entry['wallet_id'] != wallet_id:
+            _chat_handles_by_wallet.pop(stale_entry['wallet_id'], None)
+        _chat_handles[handle.lower()] = {'wallet_id': wallet_id, 'handle': handle, 'when': time.time()}
+        _chat_handles_by_wallet[wallet_id] = handle.lower()
+
+
+def find_chat_handle(mongo_db, handle, use_cache=True):
+    """Returns a dict with the wallet_id and handle (as the user cased it) for the given chat handle (case
+    insensitively), or None if no one has it. Cached handles may be up to CHAT_HANDLE_CACHE_TTL seconds out of date
+    (if changed by another process): specify use_cache=False where that matters (e.g. routing a private message)"""
+    handle_lower = handle.lower()
+    entry = _chat_handles.get(handle_lower, None)
+    if not use_cache or entry is None or time.time() - entry['when'] >= CHAT_HANDLE_CACHE_TTL:
+        p = mongo_db.chat_handles.find_one({'handle_lower': handle_lower}, {'wallet_id': 1, 'handle': 1})
+        if not p:
+            if entry is not None: #the handle was renamed (or its owner's record went away)
+                set_cached_chat_handle(entry['wallet_id'], None)
+            return None
+        set_cached_chat_handle(p['wallet_id'], p['handle'])
+        entry = _chat_handles[handle_lower]
+    return entry
+
+
+_handle_sessions = {} #key = lower-cased chat handle, value = set of the chat sessions (namespaces) chatting with it on this server
+
+
+def get_handle_sessions(handle):
+    """Returns the chat sessions on this server chatting with the given handle (case insensitive)"""
+    return list(_handle_sessions.get(handle.lower(), []))
+
+
+def set_session_handle(session, handle):
+    """sets the handle the chat session is chatting with (or clears it, if handle is None), keeping the
+    handle-to-sessions index in step"""
+    old_handle = session.socket.session.get('handle', None)
+    if old_handle is not None:
+        sessions = _handle_sessions.get(old_handle.lower(), None)
+        if sessions is not None:
+            sessions.discard(session)
+            if not sessions:
+                del _handle_sessions[old_handle.lower()]
+    if handle is None:
+        session.socket.session.pop('handle', None)
+    else:
+        session.socket.session['handle'] = handle
+        _handle_sessions.setdefault(handle.lower(), set()).add(session)
+
+
 class ChatFeedServerNamespace(BaseNamespace, BroadcastMixin):
     MAX_TEXT_LEN = 500
     TIME_BETWEEN_MESSAGES = 10 #in seconds (auto-adjust this in the future based on chat speed/volume)
@@ -77,19 +287,19 @@ class ChatFeedServerNamespace(BaseNamespace, BroadcastMixin):
     
     def disconnect(self, silent=False):
         """Triggered when the client disconnects (e.g. client closes their browser)"""
+        set_session_handle(self, None)
         #record the client as offline
         if 'wallet_id' not in self.socket.session:
-            logging.warn("wallet_id not found in socket session: %s" % socket.session)
+            logging.warn("wallet_id not found in socket session: %s" % self.socket.session)
             return super(ChatFeedServerNamespace, self).disconnect(silent=silent)
-        if self.socket.session['wallet_id'] in onlineClients:
-            del onlineClients[self.socket.session['wallet_id']]
+        presence.remove_session(self.socket.session['wallet_id'], self)
         return super(ChatFeedServerNamespace, self).disconnect(silent=silent)
     
     def on_ping(self, wallet_id):
         """used to force a triggering of the connection tracking""" 
         #record the client as online
         self.socket.session['wallet_id'] = wallet_id
-        onlineClients[wallet_id] = {'when': datetime.datetime.utcnow(), 'state': self}
+        presence.add_session(wallet_id, self)
         return True
     
     def on_start_chatting(self, wallet_id, is_primary_server):
@@ -111,8 +321,9 @@ class ChatFeedServerNamespace(BaseNamespace, BroadcastMixin):
         handle = chat_profile['handle'] if chat_profile else None
         if not handle:
             return self.error('invalid_id', "No handle is defined for wallet ID %s" % self.socket.session['wallet_id'])
+        set_cached_chat_handle(self.socket.session['wallet_id'], handle)
         self.socket.session['is_primary_server'] = is_primary_server
-        self.socket.session['handle'] = handle
+        set_session_handle(self, handle)
         self.socket.session['is_op'] = chat_profile.get('is_op', False)
         self.socket.session['banned_until'] = chat_profile.get('banned_until', None)
         self.socket.session['last_action'] = None
@@ -135,10 +346,10 @@ class ChatFeedServerNamespace(BaseNamespace, BroadcastMixin):
             if len(args) != 1:
                 return self.error('invalid_args', "USAGE: /online {handle=}<br/>Desc: Determines whether a specific user is online")
             handle = args[0]
-            p = self.request['mongo_db'].chat_handles.find_one({ 'handle': { '$regex': '^%s$' % handle, '$options': 'i' } })
+            p = find_chat_handle(self.request['mongo_db'], handle)
             if not p:
                 return self.error('invalid_args', "Handle '%s' not found" % handle)
-            return self.emit("online_status", p['handle'], p['wallet_id'] in onlineClients)
+            return self.emit("online_status", p['handle'], presence.is_online(p['wallet_id']))
         elif command == 'msg': #/msg <handle> <message text>
             if not self.socket.session['is_primary_server']: return
             if len(args) < 2:
@@ -155,30 +366,33 @@ class ChatFeedServerNamespace(BaseNamespace, BroadcastMixin):
                 return self.error('banned', "Your handle is still banned from chat for %s more seconds."
                     % int((self.socket.session['banned_until'] - now).total_seconds()))
             
-            p = self.request['mongo_db'].chat_handles.find_one({ 'handle': { '$regex': '^%s$' % handle, '$options': 'i' } })
+            p = find_chat_handle(self.request['mongo_db'], handle, use_cache=False)
             if not p:
                 return self.error('invalid_args', "Handle '%s' not found" % handle)
-            if p['wallet_id'] not in onlineClients:
+            #(only the handle's current owner: a session may still be chatting with a handle renamed elsewhere)
+            sessions = [s for s in get_handle_sessions(p['handle'])
+                if s.socket.session.get('wallet_id', None) == p['wallet_id']]
+            if not sessions:
+                if presence.is_online(p['wallet_id']):
+                    return self.error('invalid_args', "Handle '%s' is not connected to this chat server" % p['handle'])
                 return self.error('invalid_args', "Handle '%s' is not online" % p['handle'])
             
             #truncate to max allowed and strip out HTML
             message = lxml.html.document_fromstring(message[:self.MAX_TEXT_LEN]).text_content()
-            onlineClients[p['wallet_id']]['state'].emit("emote", self.socket.session['handle'],
-                message, self.socket.session['is_op'], True)
+            for session in sessions:
+                session.emit("emote", self.socket.session['handle'], message, self.socket.session['is_op'], True)
         elif command in ['op', 'unop']: #/op|unop <handle>
             if len(args) != 1:
                 return self.error('invalid_args', "USAGE: /op|unop {handle to op/unop}<br/>Desc: Gives/removes operator priveledges from a specific user")
             handle = args[0]
-            p = self.request['mongo_db'].chat_handles.find_one({ 'handle': { '$regex': '^%s$' % handle, '$options': 'i' } })
+            p = self.request['mongo_db'].chat_handles.find_one({'handle_lower': handle.lower()})
             if not p:
                 return self.error('invalid_args', "Handle '%s' not found" % handle)
             p['is_op'] = command == 'op'
             self.request['mongo_db'].chat_handles.save(p)
             #make the change active immediately
-            handle_lower = handle.lower()
-            for sessid, socket in self.socket.server.sockets.iteritems():
-                if socket.session.get('handle', None).lower() == handle_lower:
-                    socket.session['is_op'] = p['is_op']
+            for session in get_handle_sessions(handle):
+                session.socket.session['is_op'] = p['is_op']
             if self.socket.session['is_primary_server']: #let all users know
                 self.broadcast_event("oped" if command == "op" else "unoped", self.socket.session['handle'], p['handle'])
         elif command == 'ban': #/ban <handle> <time length in seconds>
@@ -192,17 +406,15 @@ class ChatFeedServerNamespace(BaseNamespace, BroadcastMixin):
             except:
                 return self.error('invalid_args', "Invalid ban_period value: '%s'" % ban_period)
                 
-            p = self.request['mongo_db'].chat_handles.find_one({ 'handle': { '$regex': '^%s$' % handle, '$options': 'i' } })
+            p = self.request['mongo_db'].chat_handles.find_one({'handle_lower': handle.lower()})
             if not p:
                 return self.error('invalid_args', "Handle '%s' not found" % handle)
             p['banned_until'] = datetime.datetime.utcnow() + datetime.timedelta(seconds=ban_period) if ban_period != -1 else -1
             #^ can be the special value of -1 to mean "ban indefinitely"
             self.request['mongo_db'].chat_handles.save(p)
             #make the change active immediately
-            handle_lower = handle.lower()
-            for sessid, socket in self.socket.server.sockets.iteritems():
-                if socket.session.get('handle', None).lower() == handle_lower:
-                    socket.session['banned_until'] = p['banned_until']
+            for session in get_handle_sessions(handle):
+                session.socket.session['banned_until'] = p['banned_until']
             if self.socket.session['is_primary_server']: #let all users know
                 self.broadcast_event("banned", self.socket.session['handle'], p['handle'], ban_period,
                     int(time.mktime(p['banned_until'].timetuple()))*1000 if p['banned_until'] != -1 else -1);
@@ -210,16 +422,14 @@ class ChatFeedServerNamespace(BaseNamespace, BroadcastMixin):
             if len(args) != 1:
                 return self.error('invalid_args', "USAGE: /unban {handle to unban}<br/>Desc: Unban a specific banned user")
             handle = args[0]
-            p = self.request['mongo_db'].chat_handles.find_one({ 'handle': { '$regex': '^%s$' % handle, '$options': 'i' } })
+            p = self.request['mongo_db'].chat_handles.find_one({'handle_lower': handle.lower()})
             if not p:
                 return self.error('invalid_args', "Handle '%s' not found" % handle)
             p['banned_until'] = None
             self.request['mongo_db'].chat_handles.save(p)
             #make the change active immediately
-            handle_lower = handle.lower()
-            for sessid, socket in self.socket.server.sockets.iteritems():
-                if socket.session.get('handle', None).lower() == handle_lower:
-                    socket.session['banned_until'] = None
+            for session in get_handle_sessions(handle):
+                session.socket.session['banned_until'] = None
             if self.socket.session['is_primary_server']:  #let all users know
                 self.broadcast_event("unbanned", self.socket.session['handle'], p['handle'])
         elif command == 'handle': #/handle <oldhandle> <newhandle>
@@ -232,19 +442,22 @@ class ChatFeedServerNamespace(BaseNamespace, BroadcastMixin):
                     "The new handle ('%s') must be different than the current handle ('%s')" % (new_handle, handle))
             if not re.match(r'[A-Za-z0-9_-]{4,12}', new_handle):            
                 return self.error('invalid_args', "New handle ('%s') contains invalid characters or is not between 4 and 12 characters" % new_handle)
-            p = self.request['mongo_db'].chat_handles.find_one({ 'handle': { '$regex': '^%s$' % handle, '$options': 'i' } })
+            p = self.request['mongo_db'].chat_handles.find_one({'handle_lower': handle.lower()})
             if not p:
                 return self.error('invalid_args', "Handle '%s' not found" % handle)
-            new_handle_p = self.request['mongo_db'].chat_handles.find_one({"handle": new_handle})
-            if new_handle_p:
+            new_handle_p = self.request['mongo_db'].chat_handles.find_one({'handle_lower': new_handle.lower()}, {'_id': 1})
+            if new_handle_p and new_handle_p['_id'] != p['_id']: #(allow changing just the case of a handle)
                 return self.error('invalid_args', "Hanle '%s' already exists" % new_handle)
             p['handle'] = new_handle
-            self.request['mongo_db'].chat_handles.save(p)
+            p['handle_lower'] = new_handle.lower()
+            try:
+                self.request['mongo_db'].chat_handles.save(p)
+            except pymongo.errors.DuplicateKeyError: #someone else just took it
+                return self.error('invalid_args', "Hanle '%s' already exists" % new_handle)
+            set_cached_chat_handle(p['wallet_id'], new_handle)
             #make the change active immediately
-            handle_lower = handle.lower()
-            for sessid, socket in self.socket.server.sockets.iteritems():
-                if socket.session.get('handle', None).lower() == handle_lower:
-                    socket.session['handle'] = new_handle
+            for session in get_handle_sessions(handle):
+                set_session_handle(session, new_handle)
             if self.socket.session['is_primary_server']: #let all users know
                 self.broadcast_event("handle_changed", self.socket.session['handle'], p['handle'], new_handle)
         elif command in ['enextinfo', 'disextinfo']:
@@ -0,0 +1,119 @@
+"""
+snapshot: export/import of counterwalletd's derived (blockfeed-built) state, for bootstrapping new nodes
+
+A snapshot is a gzip-compressed file of JSON lines. The first line is a header recording the block it was taken at
+(index and hash), along with the database version and network. Each following line is a chunk of documents from one
+of the snapshotted collections, as {"collection": ..., "docs": [...]}, with mongo types encoded via bson's json_util.
+"""
+import logging
+import datetime
+import time
+import json
+import gzip
+
+import pymongo
+from bson import json_util
+
+from lib import (config, database)
+
+SNAPSHOT_FORMAT_VERSION = 1
+SNAPSHOT_CHUNK_SIZE = 1000 #number of documents per chunk (line) in the snapshot file
+
+#the collections making up a snapshot, with the field that ties each record to a block (if any), so that we can
+# tell if there are records from blocks after the snapshot height (e.g. if the blockfeed died partway through a flush)
+SNAPSHOT_COLLECTIONS = [
+    ('processed_blocks', 'block_index'),
+    ('block_undo', 'block_index'),
+    ('tracked_assets', '_at_block'),
+    ('tracked_asset_history', '_superseded_at_block'),
+    ('trades', 'block_index'),
+    ('balance_changes', 'block_index'),
+    ('asset_market_info', None),
+    ('asset_marketcap_history', 'block_index'),
+    ('asset_extended_info', None),
+    ('event_log', 'block_index'),
+    ('app_config', None),
+]
+
+
+def export_snapshot(mongo_db, path):
+    """Writes out the derived collections to a snapshot file at path, as of the last block we have processed.
+    counterwalletd should not be running against this database while the export is done"""
+    app_config = mongo_db.app_config.find_one()
+    last_block = mongo_db.processed_blocks.find_one(sort=[("block_index", pymongo.DESCENDING)])
+    if not app_config or not last_block:
+        raise Exception("No processed blocks in the database to snapshot")
+    header = {
+        'snapshot_version': SNAPSHOT_FORMAT_VERSION,
+        'db_version': app_config['db_version'],
+        'running_testnet': app_config['running_testnet'],
+        'block_index': last_block['block_index'],
+        'block_hash': last_block['block_hash'],
+        'created': datetime.datetime.utcnow().isoformat(),
+    }
+    #records from blocks past the last processed block can't just be left out, as they may have replaced (or
+    # superseded) earlier state that belongs in the snapshot. rolling them back is the blockfeed's job
+    for collection, block_field in SNAPSHOT_COLLECTIONS:
+        if block_field and mongo_db[collection].find_one({block_field: {'$gt': header['block_index']}}, {'_id': 1}):
+            raise Exception("There are %s records past the last processed block (%i). Start counterwalletd to have "
+                "the blockfeed prune back the partially processed blocks, then export again" % (collection, header['block_index']))
+    logging.warn("Exporting snapshot at block %i (%s) to %s ..." % (header['block_index'], header['block_hash'], path))
+    start_time = time.time()
+    f = gzip.open(path, 'wb')
+    try:
+        f.write(json.dumps(header) + '\n')
+        for collection, block_field in SNAPSHOT_COLLECTIONS:
+            num_docs = 0
+            chunk = []
+            for doc in mongo_db[collection].find().sort('_id', pymongo.ASCENDING):
+                chunk.append(doc)
+                if len(chunk) == SNAPSHOT_CHUNK_SIZE:
+                    f.write(json.dumps({'collection': collection, 'docs': chunk}, default=json_util.default) + '\n')
+                    num_docs += len(chunk)
+                    chunk = []
+            if chunk:
+                f.write(json.dumps({'collection': collection, 'docs': chunk}, default=json_util.default) + '\n')
+                num_docs += len(chunk)
+            logging.info("Snapshot export: wrote %i records from %s" % (num_docs, collection))
+    finally:
+        f.close()
+    logging.warn("Exported snapshot at block %i in %.1f seconds" % (header['block_index'], time.time() - start_time))
+    return header
+
+
+def import_snapshot(mongo_db, path):
+    """Replaces the derived collections with the contents of the snapshot file at path. When next started,
+    the blockfeed resumes from the block the snapshot was taken at. counterwalletd should not be running against
+    this database while the import is done"""
+    f = gzip.open(path, 'rb')
+    try:
+        header = json.loads(f.readline())
+        if header.get('snapshot_version', None) != SNAPSHOT_FORMAT_VERSION:
+            raise Exception("Unsupported snapshot format version: %s" % header.get('snapshot_version', None))
+        if header['running_testnet'] != config.TESTNET:
+            raise Exception("Snapshot is for %s, but we are running on %s" % (
+                "testnet" if header['running_testnet'] else "mainnet", "testnet" if config.TESTNET else "mainnet"))
+        if header['db_version'] > config.DB_VERSION:
+            raise Exception("Snapshot is from a newer counterwalletd database version (%i, we are at %i)" % (
+                header['db_version'], config.DB_VERSION))
+        logging.warn("Importing snapshot at block %i (%s) from %s ..." % (header['block_index'], header['block_hash'], path))
+        start_time = time.time()
+
+        for collection, block_field in SNAPSHOT_COLLECTIONS:
+            mongo_db[collection].drop()
+        num_docs = dict([(collection, 0) for collection, block_field in SNAPSHOT_COLLECTIONS])
+        for line in f:
+            chunk = json.loads(line, object_hook=json_util.object_hook)
+            assert chunk['collection'] in num_docs
+            mongo_db[chunk['collection']].insert(chunk['docs'])
+            num_docs[chunk['collection']] += len(chunk['docs'])
+        for collection, block_field in SNAPSHOT_COLLECTIONS:
+            logging.info("Snapshot import: loaded %i records into %s" % (num_docs[collection], collection))
+    finally:
+        f.close()
+
+    #rebuild the indexes on the collections we replaced (the secondary indexes are built by the blockfeed on startup,
+    # unless the snapshot was taken during a fast rebuild, in which case they are built once it is caught up)
+    database.init_base_indexes(mongo_db)
+    logging.warn("Imported snapshot at block %i in %.1f seconds" % (header['block_index'], time.time() - start_time))
+    return header
@@ -5,14 +5,13 @@ import base64
 import logging
 import datetime
 import time
-import copy
 import decimal
 
 import numpy
 import pymongo
 import grequests
 
-from . import (config,)
+from . import (config, cache)
 
 D = decimal.Decimal
 
@@ -50,6 +49,8 @@ def assets_to_asset_pair(asset1, asset2):
         quote = asset2 if asset1 < asset2 else asset1
     return (base, quote)
 
+rpc_recorder = None #if set, called with (method, params, result) for each counterpartyd API call (see mockcpd.RPCRecorder)
+
 def call_jsonrpc_api(method, params=None, endpoint=None, auth=None, abort_on_error=False):
     if not endpoint: endpoint = config.COUNTERPARTYD_RPC
     if not auth: auth = config.COUNTERPARTYD_AUTH
@@ -73,6 +74,8 @@ def call_jsonrpc_api(method, params=None, endpoint=None, auth=None, abort_on_err
         raise Exception("Bad status code returned from counterpartyd: '%s'. result body: '%s'." % (r.status_code, r.text))
     else:
         result = r.json()
+    if rpc_recorder:
+        rpc_recorder(method, params, result)
     if abort_on_error and 'error' in result:
         raise Exception("Got back error from server: %s" % result['error'])
     return result
@@ -97,15 +100,79 @@ def get_address_cols_for_entity(entity):
         return ['address',]
     elif entity in ['issuances',]:
         return ['issuer',]
-    elif entity in ['sends', 'dividends', 'bets', 'cancels', 'callbacks', 'orders', 'burns', 'broadcasts', 'btcpays']:
+    elif entity in ['sends', 'dividends', 'bets', 'cancels', 'callbacks', 'orders', 'burns', 'broadcasts', 'btcpays',
+                    'order_expirations', 'bet_expirations']:
         return ['source',]
     #elif entity in ['order_matches', 'bet_matches']:
-    elif entity in ['order_matches', 'order_expirations', 'order_match_expirations',
-                    'bet_matches', 'bet_expirations', 'bet_match_expirations']:
+    elif entity in ['order_matches', 'order_match_expirations', 'bet_matches', 'bet_match_expirations']:
         return ['tx0_address', 'tx1_address']
     else:
         raise Exception("Unknown entity type: %s" % entity)
 
+def get_addresses_for_event(event):
+    """Returns the addresses involved in a message feed event"""
+    try:
+        address_cols = get_address_cols_for_entity(event['_category'])
+    except Exception: #not an entity with addresses (e.g. a reorg)
+        return []
+    if event['_category'] in ['sends', 'btcpays']:
+        address_cols = address_cols + ['destination',]
+    return list(set([event[c] for c in address_cols if event.get(c, None)]))
+
+def get_asset_pair_for_event(event):
+    """Returns the (base, quote) asset pair a message feed event is for (for orders and order matches), or None"""
+    if event['_category'] == 'orders' and event.get('give_asset', None) and event.get('get_asset', None):
+        return assets_to_asset_pair(event['give_asset'], event['get_asset'])
+    elif event['_category'] == 'order_matches' and event.get('forward_asset', None) and event.get('backward_asset', None):
+        return assets_to_asset_pair(event['forward_asset'], event['backward_asset'])
+    return None
+
+def get_event_routing(events):
+    """Returns a list with the (addresses, asset_pair) each of the given message feed events is for, for filtering
+    the message feed and indexing the event log (asset_pair is None for events not about an order or order match).
+    Order and order match updates, order (match) expirations and BTCpays don't carry all of this themselves, so the
+    orders and order matches they are about are looked up from counterpartyd (with at most one call for each)"""
+    order_hashes = set()
+    order_match_ids = set()
+    for event in events:
+        if event['_category'] == 'orders' and not event.get('give_asset', None): #order update
+            order_hashes.add(event['tx_hash'])
+        elif event['_category'] == 'order_expirations':
+            order_hashes.add(event['order_hash'])
+        elif event['_category'] in ['order_matches', 'order_match_expirations', 'btcpays'] \
+           and not event.get('forward_asset', None): #(i.e. not an order match insert)
+            order_match_ids.add(event['order_match_id'])
+
+    orders = {} #key = tx_hash
+    if order_hashes:
+        for order in call_jsonrpc_api("get_orders", {
+          'filters': [{'field': 'tx_hash', 'op': '==', 'value': tx_hash} for tx_hash in order_hashes],
+          'filterop': 'or'}, abort_on_error=True)['result']:
+            orders[order['tx_hash']] = order
+    order_matches = {} #key = order match ID (tx0_hash + tx1_hash)
+    if order_match_ids:
+        for order_match in call_jsonrpc_api("get_order_matches", {
+          'filters': [{'field': 'tx0_hash', 'op': '==', 'value': tx0_hash}
+            for tx0_hash in set([order_match_id[:64] for order_match_id in order_match_ids])],
+          'filterop': 'or'}, abort_on_error=True)['result']:
+            order_matches[order_match['tx0_hash'] + order_match['tx1_hash']] = order_match
+
+    routing = []
+    for event in events:
+        addresses = get_addresses_for_event(event)
+        asset_pair = get_asset_pair_for_event(event)
+        order = orders.get(event.get('order_hash', None) or event.get('tx_hash', None), None) \
+            if event['_category'] in ['orders', 'order_expirations'] else None
+        order_match = order_matches.get(event.get('order_match_id', None), None)
+        if order:
+            addresses = list(set(addresses + [order['source'],]))
+            asset_pair = assets_to_asset_pair(order['give_asset'], order['get_asset'])
+        elif order_match:
+            addresses = list(set(addresses + [order_match['tx0_address'], order_match['tx1_address']]))
+            asset_pair = assets_to_asset_pair(order_match['forward_asset'], order_match['backward_asset'])
+        routing.append((addresses, asset_pair))
+    return routing
+
 def multikeysort(items, columns):
     """http://stackoverflow.com/a/1144405"""
     from operator import itemgetter
@@ -145,6 +212,15 @@ def json_dthandler(obj):
 def get_block_indexes_for_dates(mongo_db, start_dt=None, end_dt=None):
     """Returns a 2 tuple (start_block, end_block) result for the block range that encompasses the given start_date
     and end_date unix timestamps"""
+    if cache.get_block_time(config.CURRENT_BLOCK_INDEX) is not None: #search our block time table
+        start_block_index, end_block_index = cache.get_block_indexes_for_dates(start_dt=start_dt, end_dt=end_dt)
+        if start_block_index is None:
+            start_block_index = config.BLOCK_FIRST
+        if end_block_index is None:
+            end_block_index = config.CURRENT_BLOCK_INDEX
+        return (start_block_index, end_block_index)
+    
+    #block time table not loaded yet: go out to the database
     if start_dt is None:
         start_block_index = config.BLOCK_FIRST
     else:
@@ -161,7 +237,10 @@ def get_block_indexes_for_dates(mongo_db, start_dt=None, end_dt=None):
     return (start_block_index, end_block_index)
 
 def get_block_time(mongo_db, block_index):
-    """TODO: implement result caching to avoid having to go out to the database"""
+    block_time = cache.get_block_time(block_index)
+    if block_time is not None:
+        return block_time
+    #not in our block time table (e.g. if it is not loaded yet)
     block = mongo_db.processed_blocks.find_one({"block_index": block_index })
     if not block: return None
     return block['block_time']
@@ -185,8 +264,8 @@ def get_market_price_summary(mongo_db, asset1, asset2, with_last_trades=0, start
     
     #look for the last max 6 trades within the past 10 day window
     base_asset, quote_asset = assets_to_asset_pair(asset1, asset2)
-    base_asset_info = mongo_db.tracked_assets.find_one({'asset': base_asset})
-    quote_asset_info = mongo_db.tracked_assets.find_one({'asset': quote_asset})
+    base_asset_info = cache.get_asset(mongo_db, base_asset)
+    quote_asset_info = cache.get_asset(mongo_db, quote_asset)
     
     if not isinstance(with_last_trades, int) or with_last_trades < 0 or with_last_trades > 30:
         raise Exception("Invalid with_last_trades")
@@ -224,45 +303,62 @@ def get_market_price_summary(mongo_db, asset1, asset2, with_last_trades=0, start
         result['last_trades'] = []
     return result
 
-def create_message_feed_obj_from_cpd_message(mongo_db, msg, msg_data=None):
-    """This function takes a message from counterpartyd's message feed and mutates it a bit to be suitable to be
-    sent through the counterwalletd message feed to an end-client"""
-    if not msg_data:
-        msg_data = json.loads(msg['bindings'])
+def create_message_feed_objs_from_cpd_messages(mongo_db, msgs, bal_changes=None):
+    """Takes a list of messages from counterpartyd's message feed (e.g. all those for a block), and mutates them a bit
+    to be suitable to be sent through the counterwalletd message feed to end-clients. Asset info comes from the
+    asset cache.
+    
+    @param msgs: A list of (msg, msg_data) tuples, where msg_data is the message's parsed bindings (or None, to parse
+    them here). The event is a shallow copy of a given msg_data, so the caller must not modify its values after
+    @param bal_changes: For credits and debits, a dict of the balance change records resulting from the messages,
+    keyed by message_index, if the caller has them. Those not given are looked up from the database (once for each
+    address/asset pair in the batch)"""
+    events = []
+    last_bal_changes = {} #(address, asset) pairs we had to look up the last balance change for
+    for msg, msg_data in msgs:
+        event = dict(msg_data) if msg_data else json.loads(msg['bindings'])
+        event['_message_index'] = msg['message_index']
+        event['_command'] = msg['command']
+        event['_block_index'] = msg['block_index']
+        event['_category'] = msg['category']
+        event['_status'] = event.get('status', 'valid')
     
-    event = copy.deepcopy(msg_data)
-    event['_message_index'] = msg['message_index']
-    event['_command'] = msg['command']
-    event['_block_index'] = msg['block_index']
-    event['_category'] = msg['category']
-    event['_status'] = msg_data.get('status', 'valid')
+        #insert custom fields in certain events...
+        #even invalid actions need these extra fields for proper reporting to the client (as the reporting message
+        # is produced via PendingActionViewModel.calcText) -- however make it able to deal with the queried data not existing in this case
+        if(event['_category'] in ['credits', 'debits']):
+            bal_change = bal_changes.get(msg['message_index'], None) if bal_changes else None
+            if not bal_change: #find the last balance change on record
+                pair = (event['address'], event['asset'])
+                if pair not in last_bal_changes:
+                    last_bal_changes[pair] = mongo_db.balance_changes.find_one({'address': pair[0], 'asset': pair[1]},
+                        sort=[("block_time", pymongo.DESCENDING)])
+                bal_change = last_bal_changes[pair]
+            event['_quantity_normalized'] = abs(bal_change['quantity_normalized']) if bal_change else None
+            event['_balance'] = bal_change['new_balance'] if bal_change else None
+            event['_balance_normalized'] = bal_change['new_balance_normalized'] if bal_change else None
+        elif(event['_category'] in ['orders',] and event['_command'] == 'insert'):
+            get_asset_info = cache.get_asset(mongo_db, event['get_asset'])
+            give_asset_info = cache.get_asset(mongo_db, event['give_asset'])
+            event['_get_asset_divisible'] = get_asset_info['divisible'] if get_asset_info else None
+            event['_give_asset_divisible'] = give_asset_info['divisible'] if give_asset_info else None
+        elif(event['_category'] in ['order_matches',] and event['_command'] == 'insert'):
+            forward_asset_info = cache.get_asset(mongo_db, event['forward_asset'])
+            backward_asset_info = cache.get_asset(mongo_db, event['backward_asset'])
+            event['_forward_asset_divisible'] = forward_asset_info['divisible'] if forward_asset_info else None
+            event['_backward_asset_divisible'] = backward_asset_info['divisible'] if backward_asset_info else None
+        elif(event['_category'] in ['dividends', 'sends',]):
+            asset_info = cache.get_asset(mongo_db, event['asset'])
+            event['_divisible'] = asset_info['divisible'] if asset_info else None
+        elif(event['_category'] in ['issuances',]):
+            event['_quantity_normalized'] = normalize_quantity(event['quantity'], event['divisible'])
+        events.append(event)
+    return events
 
-    #insert custom fields in certain events...
-    #even invalid actions need these extra fields for proper reporting to the client (as the reporting message
-    # is produced via PendingActionViewModel.calcText) -- however make it able to deal with the queried data not existing in this case
-    if(event['_category'] in ['credits', 'debits']):
-        #find the last balance change on record
-        bal_change = mongo_db.balance_changes.find_one({ 'address': event['address'], 'asset': event['asset'] },
-            sort=[("block_time", pymongo.DESCENDING)])
-        event['_quantity_normalized'] = abs(bal_change['quantity_normalized']) if bal_change else None
-        event['_balance'] = bal_change['new_balance'] if bal_change else None
-        event['_balance_normalized'] = bal_change['new_balance_normalized'] if bal_change else None
-    elif(event['_category'] in ['orders',] and event['_command'] == 'insert'):
-        get_asset_info = mongo_db.tracked_assets.find_one({'asset': event['get_asset']})
-        give_asset_info = mongo_db.tracked_assets.find_one({'asset': event['give_asset']})
-        event['_get_asset_divisible'] = get_asset_info['divisible'] if get_asset_info else None
-        event['_give_asset_divisible'] = give_asset_info['divisible'] if give_asset_info else None
-    elif(event['_category'] in ['order_matches',] and event['_command'] == 'insert'):
-        forward_asset_info = mongo_db.tracked_assets.find_one({'asset': event['forward_asset']})
-        backward_asset_info = mongo_db.tracked_assets.find_one({'asset': event['backward_asset']})
-        event['_forward_asset_divisible'] = forward_asset_info['divisible'] if forward_asset_info else None
-        event['_backward_asset_divisible'] = backward_asset_info['divisible'] if backward_asset_info else None
-    elif(event['_category'] in ['dividends', 'sends',]):
-        asset_info = mongo_db.tracked_assets.find_one({'asset': event['asset']})
-        event['_divisible'] = asset_info['divisible'] if asset_info else None
-    elif(event['_category'] in ['issuances',]):
-        event['_quantity_normalized'] = normalize_quantity(msg_data['quantity'], msg_data['divisible'])
-    return event
+def create_message_feed_obj_from_cpd_message(mongo_db, msg, msg_data=None, bal_change=None):
+    """Single message version of create_message_feed_objs_from_cpd_messages"""
+    return create_message_feed_objs_from_cpd_messages(mongo_db, [(msg, msg_data)],
+        bal_changes={msg['message_index']: bal_change} if bal_change else None)[0]
 
 
 #############
@@ -297,5 +393,8 @@ def get_btc_supply(normalize=False, at_block_index=None):
 
 def is_caught_up_well_enough_for_government_work():
     """We don't want to give users 525 errors or login errors if counterwalletd/counterpartyd is in the process of
-    getting caught up, but we DO if counterwallet is either clearly out of date with the blockchain, or reinitializing its database"""
+    getting caught up, but we DO if counterwallet is either clearly out of date with the blockchain, or reinitializing its database
+    (including while building the secondary indexes deferred during a fast rebuild)"""
+    if not config.SECONDARY_INDEXES_BUILT:
+        return False
     return config.CAUGHT_UP or (config.INSIGHT_LAST_BLOCK and config.CURRENT_BLOCK_INDEX >= config.INSIGHT_LAST_BLOCK - 1)